@@ -0,0 +1,53 @@
+"""Benchmark href extraction from directory listings against BeautifulSoup,
+which get_lines used before, on the listings in the test fixtures.
+
+Run from the repository root with the package and its test extras installed:
+
+    python benchmarks/get_lines.py --number 200
+"""
+
+import argparse
+from glob import glob
+from os.path import basename, join
+from timeit import repeat
+from typing import List
+
+from bs4 import BeautifulSoup
+
+from hdx.scraper.copernicus.utilities import _get_hrefs
+
+_LISTINGS = join("tests", "fixtures", "input", "*.txt")
+
+
+def get_hrefs_soup(text: str) -> List[str]:
+    soup = BeautifulSoup(text, "html.parser")
+    return [a.get("href") for a in soup.find_all("a") if a.get("href")]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    for file_path in sorted(glob(_LISTINGS)):
+        with open(file_path) as f:
+            text = f.read()
+        assert _get_hrefs(text) == get_hrefs_soup(text)
+        timings = {}
+        for name, function in (
+            ("soup", get_hrefs_soup),
+            ("parser", _get_hrefs),
+        ):
+            seconds = repeat(
+                lambda: function(text), number=args.number, repeat=args.runs
+            )
+            timings[name] = min(seconds) / args.number * 1000
+        print(
+            f"{basename(file_path)}: soup {timings['soup']:.3f}ms, "
+            f"parser {timings['parser']:.3f}ms "
+            f"({timings['soup'] / timings['parser']:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""Benchmark the raster and boundary hot paths offline on synthetic inputs:
+country boundaries laid out on a grid, GHSL tiles covering them, a FAPAR zip
+of dekad rasters and a zip of dekad drought tracking clusters. Each stage runs
+in a fresh process and its wall time, peak RSS and bytes written are saved as
+JSON so two revisions can be compared.
+
+Run from the repository root with the package installed:
+
+    python benchmarks/hot_paths.py --countries 16 --output before.json
+    python benchmarks/hot_paths.py --countries 16 --output after.json \
+        --compare before.json
+"""
+
+import argparse
+import resource
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from json import dump, dumps, load
+from math import ceil, floor, sqrt
+from multiprocessing import get_context
+from os import makedirs, walk
+from os.path import getsize, join
+from subprocess import CalledProcessError, check_output
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Dict, List
+from zipfile import ZipFile
+
+import rasterio
+from geopandas import GeoDataFrame, read_file
+from hdx.location.country import Country
+from hdx.utilities.downloader import Download
+from hdx.utilities.loader import load_yaml
+from hdx.utilities.path import script_dir_plus_file
+from hdx.utilities.retriever import Retrieve
+from numpy.random import default_rng
+from rasterio.transform import from_origin
+from shapely.geometry import Point, Polygon, box, mapping
+
+from hdx.scraper.copernicus.cache import GeometryCache
+from hdx.scraper.copernicus.drought import Drought
+from hdx.scraper.copernicus.ghsl import GHSL
+from hdx.scraper.copernicus.raster import get_zip_path
+from hdx.scraper.copernicus.utilities import make_valid_dissolve
+
+_BOUNDARY_KEY = "benchmark"
+_GHSL_RESOLUTION = 100
+_GHSL_TILES = {
+    "built": ("GHS_BUILT_S_E2020_GLOBE_R2023A_54009_100_V1_0", "uint16", 65535),
+    "population": ("GHS_POP_E2020_GLOBE_R2023A_54009_100_V1_0", "float32", -200),
+}
+_FAPAR_ZIP = "fpanv_m_gdo_20250101_20250601_t.zip"
+_TRACKING_ZIP = "jspa3_m_wld_20250101_20250601_t.zip"
+_STAGES = (
+    "make_valid_dissolve",
+    "ghsl_get_boundaries",
+    "ghsl_process",
+    "drought_process",
+    "drought_tracking_process",
+)
+
+
+def get_configuration() -> Dict:
+    return load_yaml(
+        script_dir_plus_file(join("config", "project_configuration.yaml"), GHSL)
+    )
+
+
+def get_iso3s(number: int, configuration: Dict) -> List[str]:
+    skip_countries = set(configuration["drought"]["skip_countries"])
+    skip_countries.update(configuration["ghsl"]["skip_countries"])
+    iso3s = sorted(Country.countriesdata(use_live=False)["countries"])
+    return [iso3 for iso3 in iso3s if iso3 not in skip_countries][:number]
+
+
+def make_boundaries(args: argparse.Namespace, iso3s: List[str]) -> GeoDataFrame:
+    # Round countries on a grid north of the equator, each with an invalid
+    # bow tie part and an area administered by it, as in the UN boundaries
+    columns = ceil(sqrt(len(iso3s)))
+    size = args.country_degrees
+    rows = []
+    for i, iso3 in enumerate(iso3s):
+        x = size * 1.1 * (i % columns)
+        y = 10 + size * 1.1 * (i // columns)
+        country = Point(x, y).buffer(size / 2, quad_segs=args.vertices // 4)
+        bow_tie = Polygon(
+            [(x, y), (x + size / 8, y + size / 8), (x + size / 8, y), (x, y + size / 8)]
+        )
+        administered = box(x - size / 4, y - size / 4, x - size / 8, y - size / 8)
+        rows.append({"ISO_3": iso3, "STATUS": "Member State", "geometry": country})
+        rows.append({"ISO_3": iso3, "STATUS": None, "geometry": bow_tie})
+        rows.append(
+            {
+                "ISO_3": "XXX",
+                "STATUS": f"Adm. by {iso3}",
+                "Color_Code": iso3,
+                "geometry": administered,
+            }
+        )
+    return GeoDataFrame(rows, crs="EPSG:4326")
+
+
+def make_tiles(
+    args: argparse.Namespace, folder: str, boundaries: GeoDataFrame
+) -> Dict[str, List[str]]:
+    # Tiles on a grid in Mollweide covering the countries, like the GHSL ones
+    extent = args.tile_size * _GHSL_RESOLUTION
+    minx, miny, maxx, maxy = boundaries.total_bounds
+    left = floor(minx / extent) * extent
+    top = ceil(maxy / extent) * extent
+    tile_ids = []
+    geometries = []
+    for row in range(ceil((top - miny) / extent)):
+        for column in range(ceil((maxx - left) / extent)):
+            tile_left = left + column * extent
+            tile_top = top - row * extent
+            tile = box(tile_left, tile_top - extent, tile_left + extent, tile_top)
+            if not boundaries.intersects(tile).any():
+                continue
+            tile_ids.append(f"R{row + 1}_C{column + 1}")
+            geometries.append(tile)
+    tiling_schema = GeoDataFrame(
+        {"tile_id": tile_ids}, geometry=geometries, crs=boundaries.crs
+    )
+    tiling_schema.to_file(join(folder, "tiles.gpkg"), driver="GPKG")
+    rng = default_rng(0)
+    latest_data = {}
+    for data_type, (stem, dtype, nodata) in _GHSL_TILES.items():
+        for tile_id, tile in zip(tile_ids, geometries):
+            file_name = f"{stem}_{tile_id}"
+            tif_path = join(folder, f"{file_name}.tif")
+            tile_left, _, _, tile_top = tile.bounds
+            write_raster(
+                tif_path,
+                rng.integers(0, 1000, (args.tile_size, args.tile_size)),
+                dtype,
+                nodata,
+                boundaries.crs,
+                from_origin(tile_left, tile_top, _GHSL_RESOLUTION, _GHSL_RESOLUTION),
+            )
+            zip_path = join(folder, f"{file_name}.zip")
+            with ZipFile(zip_path, "w") as z:
+                z.write(tif_path, f"{file_name}.tif")
+            latest_data.setdefault(data_type, []).append(
+                get_zip_path(zip_path, f"{file_name}.tif")
+            )
+    return latest_data
+
+
+def make_fapar(args: argparse.Namespace, folder: str, boundaries: GeoDataFrame) -> str:
+    # One zip of dekad rasters covering the countries with the text files that
+    # come with them
+    resolution = args.fapar_resolution
+    minx, miny, maxx, maxy = boundaries.total_bounds
+    left = floor(minx) - 1
+    top = ceil(maxy) + 1
+    width = ceil((ceil(maxx) + 1 - left) / resolution)
+    height = ceil((top - floor(miny) + 1) / resolution)
+    rng = default_rng(1)
+    zip_path = join(folder, _FAPAR_ZIP)
+    with ZipFile(zip_path, "w") as z:
+        for dekad in range(args.dekads):
+            date = f"2025{dekad // 3 + 1:02d}{dekad % 3 * 10 + 1:02d}"
+            file_name = f"fpanv_m_gdo_{date}_t_300_z01.tif"
+            tif_path = join(folder, file_name)
+            write_raster(
+                tif_path,
+                rng.random((height, width)) * 2 - 1,
+                "float32",
+                -9999,
+                "EPSG:4326",
+                from_origin(left, top, resolution, resolution),
+            )
+            z.write(tif_path, file_name)
+        z.writestr("copyright.txt", "Copernicus\n" * 100)
+        z.writestr("README.txt", "FAPAR anomalies\n" * 1000)
+    return zip_path
+
+
+def make_tracking(
+    args: argparse.Namespace, folder: str, boundaries: GeoDataFrame
+) -> str:
+    # One zip of dekad GeoJSON drought clusters of random size spread over
+    # the countries, some of them crossing borders
+    minx, miny, maxx, maxy = boundaries.total_bounds
+    rng = default_rng(2)
+    zip_path = join(folder, _TRACKING_ZIP)
+    with ZipFile(zip_path, "w") as z:
+        for dekad in range(args.dekads):
+            date = f"2025{dekad // 3 + 1:02d}{dekad % 3 * 10 + 1:02d}"
+            features = []
+            for cluster_id in range(args.clusters):
+                x = rng.uniform(minx, maxx)
+                y = rng.uniform(miny, maxy)
+                radius = rng.uniform(0.05, 0.5) * args.country_degrees
+                cluster = Point(x, y).buffer(radius, quad_segs=args.vertices // 4)
+                features.append(
+                    {
+                        "type": "Feature",
+                        "properties": {"id": cluster_id},
+                        "geometry": mapping(cluster),
+                    }
+                )
+            collection = {"type": "FeatureCollection", "features": features}
+            z.writestr(f"jspa3_m_wld_{date}_t.json", dumps(collection))
+        z.writestr("copyright.txt", "Copernicus\n" * 100)
+    return zip_path
+
+
+def write_raster(file_path, data, dtype, nodata, crs, transform) -> None:
+    with rasterio.open(
+        file_path,
+        "w",
+        driver="GTiff",
+        count=1,
+        height=data.shape[0],
+        width=data.shape[1],
+        dtype=dtype,
+        nodata=nodata,
+        crs=crs,
+        transform=transform,
+        compress="LZW",
+    ) as dest:
+        dest.write(data.astype(dtype), 1)
+
+
+def make_inputs(args: argparse.Namespace, folder: str) -> Dict:
+    configuration = get_configuration()
+    iso3s = get_iso3s(args.countries, configuration)
+    boundaries = make_boundaries(args, iso3s)
+    boundaries.to_file(join(folder, "boundaries.gpkg"), driver="GPKG")
+    boundaries_wgs = make_valid_dissolve(boundaries.copy())
+    boundaries_mollweide = make_valid_dissolve(boundaries.to_crs("ESRI:54009"))
+    GeometryCache(folder).save_boundaries(
+        _BOUNDARY_KEY, boundaries_wgs, boundaries_mollweide
+    )
+    latest_data = make_tiles(args, folder, boundaries_mollweide)
+    fapar_zip = make_fapar(args, folder, boundaries_wgs)
+    tracking_zip = make_tracking(args, folder, boundaries_wgs)
+    return {
+        "latest_data": latest_data,
+        "fapar_zip": fapar_zip,
+        "tracking_zip": tracking_zip,
+    }
+
+
+def run_stage(stage: str, folder: str, output_folder: str, inputs: Dict) -> Dict:
+    # Run in a fresh process so peak RSS is that of the stage alone
+    Country.countriesdata(use_live=False)
+    configuration = get_configuration()
+    boundaries_wgs, boundaries_mollweide = GeometryCache(folder).load_boundaries(
+        _BOUNDARY_KEY
+    )
+    with Download(user_agent="benchmark") as downloader:
+        retriever = Retrieve(
+            downloader, output_folder, output_folder, output_folder, False, False
+        )
+        if stage == "make_valid_dissolve":
+            boundaries = read_file(join(folder, "boundaries.gpkg"))
+            start = perf_counter()
+            make_valid_dissolve(boundaries)
+        elif stage.startswith("ghsl"):
+            ghsl = GHSL(configuration["ghsl"], retriever, boundaries_mollweide)
+            ghsl.tiling_schema = read_file(join(folder, "tiles.gpkg"))
+            if stage == "ghsl_get_boundaries":
+                start = perf_counter()
+                ghsl.get_boundaries()
+            else:
+                ghsl.get_boundaries()
+                ghsl.latest_data = inputs["latest_data"]
+                start = perf_counter()
+                for iso3 in ghsl.tiles_by_country:
+                    ghsl.process(iso3)
+        else:
+            if stage == "drought_process":
+                data_type, zip_path = "fapar", inputs["fapar_zip"]
+            else:
+                data_type, zip_path = "drought_tracking", inputs["tracking_zip"]
+            drought = Drought(configuration["drought"], retriever, boundaries_wgs)
+            drought.downloaded_data[data_type] = [zip_path]
+            file_paths = drought.list_data(data_type)
+            start = perf_counter()
+            drought.process_countries(
+                list(drought.global_boundaries), data_type, file_paths
+            )
+        seconds = perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    bytes_written = 0
+    for root, _, files in walk(output_folder):
+        bytes_written += sum(getsize(join(root, f)) for f in files)
+    return {
+        "seconds": seconds,
+        "peak_rss_mb": peak_rss / 1024**2,
+        "bytes_written": bytes_written,
+    }
+
+
+def get_revision() -> str | None:
+    try:
+        return check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+def compare(results: Dict, file_path: str) -> None:
+    with open(file_path) as f:
+        baseline = load(f)
+    print(f"Compared with {baseline['revision']} ({file_path}):")
+    for stage, result in results["stages"].items():
+        before = baseline["stages"].get(stage)
+        if not before:
+            continue
+        print(
+            f"{stage}: {get_ratio(result, before, 'seconds')} time, "
+            f"{get_ratio(result, before, 'peak_rss_mb')} peak RSS, "
+            f"{result['bytes_written'] - before['bytes_written']:+d} bytes written"
+        )
+
+
+def get_ratio(result: Dict, before: Dict, key: str) -> str:
+    # Timers can round a very fast stage down to zero
+    if not before[key]:
+        return "n/a"
+    return f"{result[key] / before[key]:.2f}x"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--countries", type=int, default=16)
+    parser.add_argument("--country-degrees", type=float, default=1.0)
+    parser.add_argument("--vertices", type=int, default=256)
+    parser.add_argument("--tile-size", type=int, default=500)
+    parser.add_argument("--fapar-resolution", type=float, default=0.01)
+    parser.add_argument("--dekads", type=int, default=3)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--stages", nargs="+", choices=_STAGES, default=_STAGES)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+    Country.countriesdata(use_live=False)
+    with TemporaryDirectory() as folder:
+        inputs = make_inputs(args, folder)
+        results = {"revision": get_revision(), "parameters": vars(args), "stages": {}}
+        for stage in args.stages:
+            runs = []
+            for run in range(args.runs):
+                output_folder = join(folder, f"{stage}_{run}")
+                makedirs(output_folder)
+                with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                    runs.append(
+                        pool.submit(
+                            run_stage, stage, folder, output_folder, inputs
+                        ).result()
+                    )
+            result = {
+                "seconds": min(r["seconds"] for r in runs),
+                "peak_rss_mb": max(r["peak_rss_mb"] for r in runs),
+                "bytes_written": runs[0]["bytes_written"],
+                "runs": runs,
+            }
+            results["stages"][stage] = result
+            print(
+                f"{stage}: {result['seconds']:.3f}s, "
+                f"{result['peak_rss_mb']:.0f} MB peak RSS, "
+                f"{result['bytes_written']} bytes written"
+            )
+    with open(args.output, "w") as f:
+        dump(results, f, indent=1)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
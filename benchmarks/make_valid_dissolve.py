@@ -0,0 +1,71 @@
+"""Benchmark make_valid_dissolve against the row by row implementation it
+replaced, using the boundary fixture repeated to a realistic size.
+
+Run from the repository root with the package installed:
+
+    python benchmarks/make_valid_dissolve.py --repeat 150
+"""
+
+import argparse
+from os.path import join
+from timeit import repeat
+
+from geopandas import GeoDataFrame, read_file
+from pandas import concat, isna
+from shapely.validation import make_valid
+
+from hdx.scraper.copernicus.utilities import make_valid_dissolve
+
+_FIXTURE = join("tests", "fixtures", "input", "wrl_polbnda_int_15m_uncs.geojson")
+
+
+def make_valid_dissolve_rows(lyr: GeoDataFrame) -> GeoDataFrame:
+    for i, row in lyr.iterrows():
+        if not lyr.geometry[i].is_valid:
+            lyr.loc[i, "geometry"] = make_valid(lyr.geometry[i])
+        if not isna(row["STATUS"]) and row["STATUS"][:4] == "Adm.":
+            lyr.loc[i, "ISO_3"] = row["Color_Code"]
+    lyr = lyr.dissolve(by="ISO_3", as_index=False)
+    lyr = lyr.drop(
+        [f for f in lyr.columns if f.lower() not in ["iso_3", "geometry"]],
+        axis=1,
+    )
+    return lyr
+
+
+def get_layer(number: int) -> GeoDataFrame:
+    # Every other copy is administered by the first country so the remap is
+    # exercised
+    lyr = read_file(_FIXTURE)
+    copies = []
+    for i in range(number):
+        copy = lyr.copy()
+        copy["ISO_3"] = [f"{iso3}{i}" for iso3 in copy["ISO_3"]]
+        if i % 2:
+            copy["STATUS"] = "Adm. by test"
+            copy["Color_Code"] = lyr["ISO_3"].iloc[0]
+        copies.append(copy)
+    return GeoDataFrame(concat(copies, ignore_index=True), crs=lyr.crs)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=150)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    lyr = get_layer(args.repeat)
+    expected = make_valid_dissolve_rows(lyr.copy())
+    result = make_valid_dissolve(lyr.copy())
+    assert list(result["ISO_3"]) == list(expected["ISO_3"])
+    assert result.geom_equals_exact(expected, 0).all()
+    print(f"{len(lyr)} boundaries")
+    for name, function in (
+        ("rows", make_valid_dissolve_rows),
+        ("vectorized", make_valid_dissolve),
+    ):
+        timings = repeat(lambda: function(lyr.copy()), number=1, repeat=args.runs)
+        print(f"{name}: {min(timings):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,14 @@ script then creates in HDX.
 
 import logging
 from os.path import expanduser, join
+from typing import Callable, Dict, List, Optional
 
 from hdx.api.configuration import Configuration
+from hdx.data.dataset import Dataset
 from hdx.data.user import User
 from hdx.facades.infer_arguments import facade
 from hdx.utilities.dateparse import now_utc
+from hdx.utilities.dictandlist import dict_of_dicts_add
 from hdx.utilities.downloader import Download
 from hdx.utilities.path import (
     script_dir_plus_file,
@@ -19,15 +22,27 @@ from hdx.utilities.path import (
 )
 from hdx.utilities.retriever import Retrieve
 
+from hdx.scraper.copernicus.cache import (
+    GeometryCache,
+    MaskIndex,
+    ValidatorCache,
+)
 from hdx.scraper.copernicus.drought import Drought
 from hdx.scraper.copernicus.ghsl import GHSL
+from hdx.scraper.copernicus.journal import RunJournal
+from hdx.scraper.copernicus.manifest import Manifest
+from hdx.scraper.copernicus.parallel import process_in_pool, split_list
+from hdx.scraper.copernicus.publisher import Publisher
+from hdx.scraper.copernicus.report import RunReport, StageRecord, stage
 from hdx.scraper.copernicus.utilities import get_boundaries
 
 logger = logging.getLogger(__name__)
 
 _USER_AGENT_LOOKUP = "hdx-scraper-copernicus"
 _SAVED_DATA_DIR = "saved_data"  # Keep in repo to avoid deletion in /tmp
+_STATE_DIR = "state"  # Kept between runs to reuse prepared geometries
 _UPDATED_BY_SCRIPT = "HDX Scraper: copernicus"
+_REPORT_FILE = "run_report.json"
 
 generate_country_datasets = True
 generate_global_datasets = True
@@ -37,12 +52,18 @@ force_update = False
 def main(
     save: bool = False,
     use_saved: bool = False,
+    processes: int = 1,
+    resume: bool = False,
+    report: bool = False,
 ) -> None:
     """Generate datasets and create them in HDX
 
     Args:
         save (bool): Save downloaded data. Defaults to False.
         use_saved (bool): Use saved data. Defaults to False.
+        processes (int): Number of processes used to process countries. Defaults to 1.
+        resume (bool): Skip stages completed by a failed run. Defaults to False.
+        report (bool): Report time, bytes and files of each stage. Defaults to False.
 
     Returns:
         None
@@ -63,92 +84,274 @@ def main(
                 save=save,
                 use_saved=use_saved,
             )
-            boundaries_wgs, boundaries_mollweide = get_boundaries(
-                configuration, retriever, temp_dir
-            )
+            journal = RunJournal(join(temp_dir, "journal.json"), resume)
+            run_report = RunReport() if report else None
+            cache = GeometryCache(_STATE_DIR)
+            with stage(run_report, "boundaries"):
+                boundaries_wgs, boundaries_mollweide = get_boundaries(
+                    configuration, retriever, temp_dir, cache
+                )
 
-            drought = Drought(configuration["drought"], retriever, boundaries_wgs)
+            listing_cache = ValidatorCache(join(_STATE_DIR, "listings.json"))
+            manifest = Manifest(join(_STATE_DIR, "drought_manifest.json"))
+            drought = Drought(
+                configuration["drought"],
+                retriever,
+                boundaries_wgs,
+                manifest,
+                listing_cache,
+                journal,
+                run_report,
+                MaskIndex(_STATE_DIR, cache.boundary_key),
+            )
             drought_updated = drought.get_data(generate_country_datasets, force_update)
             if not drought_updated:
                 logger.info("Drought data not updated")
-            if drought_updated:
-                for data_type in drought.global_data:
-                    if generate_global_datasets:
-                        dataset = drought.generate_global_dataset(data_type)
-                        dataset.update_from_yaml(
-                            script_dir_plus_file(
-                                join("config", "hdx_dataset_static.yaml"), main
-                            )
-                        )
-                        dataset.create_in_hdx(
-                            remove_additional_resources=True,
-                            match_resource_order=True,
-                            updated_by_script=_UPDATED_BY_SCRIPT,
-                            batch=info["batch"],
-                        )
-                    if generate_country_datasets:
-                        file_paths = drought.unzip_data(data_type)
-                        for iso3 in drought.global_boundaries:
-                            country_data = drought.process(iso3, file_paths)
-                            if not country_data:
-                                continue
-                            dataset = drought.generate_dataset(iso3, data_type)
+
+            def submit_drought_dataset(iso3, data_type):
+                dataset = drought.generate_dataset(iso3, data_type)
+                if not dataset or journal.get("publish", dataset["name"]):
+                    return
+                dataset.update_from_yaml(
+                    script_dir_plus_file(
+                        join("config", "hdx_dataset_static.yaml"),
+                        main,
+                    )
+                )
+                publisher.submit_steps(
+                    dataset["name"],
+                    get_drought_publish_steps(
+                        drought,
+                        journal,
+                        run_report,
+                        info["batch"],
+                        dataset,
+                        iso3,
+                        data_type,
+                    ),
+                )
+
+            def submit_ghsl_dataset(iso3):
+                dataset = ghsl.generate_dataset(iso3)
+                if not dataset or journal.get("publish", dataset["name"]):
+                    return
+                dataset.update_from_yaml(
+                    script_dir_plus_file(
+                        join("config", "hdx_dataset_static.yaml"), main
+                    )
+                )
+                dataset["notes"] = dataset["notes"].replace("\n", "  \n")
+                publisher.submit_steps(
+                    dataset["name"],
+                    get_ghsl_publish_steps(
+                        ghsl, journal, run_report, info["batch"], dataset, iso3
+                    ),
+                )
+
+            with Publisher(**configuration["publisher"]) as publisher:
+                if drought_updated:
+                    for data_type in drought.global_data:
+                        if generate_global_datasets:
+                            dataset = drought.generate_global_dataset(data_type)
                             dataset.update_from_yaml(
                                 script_dir_plus_file(
                                     join("config", "hdx_dataset_static.yaml"), main
                                 )
                             )
-                            dataset.create_in_hdx(
-                                remove_additional_resources=False,
-                                match_resource_order=False,
-                                updated_by_script=_UPDATED_BY_SCRIPT,
-                                batch=info["batch"],
-                            )
-                            drought.clean_up_resources(iso3, dataset["name"], data_type)
-
-            ghsl = GHSL(configuration["ghsl"], retriever, boundaries_mollweide)
-            ghsl_updated = ghsl.get_data(
-                year,
-                generate_country_datasets,
-            )
-            if not ghsl_updated:
-                logger.info("GHSL data not updated")
-            if ghsl_updated:
-                if generate_global_datasets:
-                    dataset = ghsl.generate_global_dataset()
-                    dataset.update_from_yaml(
-                        script_dir_plus_file(
-                            join("config", "hdx_dataset_static.yaml"), main
-                        )
-                    )
-                    dataset["notes"] = dataset["notes"].replace("\n", "  \n")
-                    dataset.create_in_hdx(
-                        remove_additional_resources=True,
-                        match_resource_order=False,
-                        updated_by_script=_UPDATED_BY_SCRIPT,
-                        batch=info["batch"],
-                    )
+                            if not journal.get("publish", dataset["name"]):
+                                with stage(run_report, "publish"):
+                                    dataset.create_in_hdx(
+                                        remove_additional_resources=True,
+                                        match_resource_order=True,
+                                        updated_by_script=_UPDATED_BY_SCRIPT,
+                                        batch=info["batch"],
+                                    )
+                                journal.mark_done("publish", dataset["name"])
+                        if generate_country_datasets:
+                            file_paths = drought.list_data(data_type)
+                            iso3s = []
+                            for iso3 in drought.global_boundaries:
+                                country_files = get_processed_drought_files(
+                                    journal, data_type, iso3, file_paths
+                                )
+                                if country_files is None:
+                                    iso3s.append(iso3)
+                                elif country_files:
+                                    dict_of_dicts_add(
+                                        drought.country_data,
+                                        data_type,
+                                        iso3,
+                                        country_files,
+                                    )
+                                    submit_drought_dataset(iso3, data_type)
+                            for iso3_list, country_data in process_in_pool(
+                                drought,
+                                "process_countries",
+                                split_list(iso3s, processes),
+                                processes,
+                                data_type,
+                                file_paths,
+                            ):
+                                drought.country_data.setdefault(data_type, {}).update(
+                                    country_data
+                                )
+                                for iso3 in iso3_list:
+                                    journal.mark_done(
+                                        "process",
+                                        f"{data_type}/{iso3}",
+                                        {
+                                            "global_files": sorted(file_paths),
+                                            "country_files": country_data.get(iso3, []),
+                                        },
+                                    )
+                                for iso3 in country_data:
+                                    submit_drought_dataset(iso3, data_type)
 
-                if generate_country_datasets:
-                    ghsl.get_tiling_schema()
-                    iso3s = ghsl.get_boundaries()
-                    for iso3 in iso3s:
-                        country_data = ghsl.process(iso3)
-                        if not country_data:
-                            continue
-                        dataset = ghsl.generate_dataset(iso3)
+                ghsl = GHSL(
+                    configuration["ghsl"],
+                    retriever,
+                    boundaries_mollweide,
+                    cache,
+                    listing_cache,
+                    journal,
+                    Manifest(join(_STATE_DIR, "ghsl_manifest.json")),
+                    ValidatorCache(join(_STATE_DIR, "sizes.json")),
+                    run_report,
+                )
+                # A resumed run carries on even though the global dataset in HDX
+                # was already updated by the failed run
+                ghsl_updated = ghsl.get_data(
+                    year,
+                    generate_country_datasets,
+                    journal.get("updated", "ghsl") is not None,
+                )
+                if not ghsl_updated:
+                    logger.info("GHSL data not updated")
+                if ghsl_updated:
+                    journal.mark_done("updated", "ghsl")
+                    if generate_global_datasets:
+                        dataset = ghsl.generate_global_dataset()
                         dataset.update_from_yaml(
                             script_dir_plus_file(
                                 join("config", "hdx_dataset_static.yaml"), main
                             )
                         )
                         dataset["notes"] = dataset["notes"].replace("\n", "  \n")
-                        dataset.create_in_hdx(
-                            remove_additional_resources=True,
-                            match_resource_order=False,
-                            updated_by_script=_UPDATED_BY_SCRIPT,
-                            batch=info["batch"],
-                        )
+                        if not journal.get("publish", dataset["name"]):
+                            with stage(run_report, "publish"):
+                                dataset.create_in_hdx(
+                                    remove_additional_resources=True,
+                                    match_resource_order=False,
+                                    updated_by_script=_UPDATED_BY_SCRIPT,
+                                    batch=info["batch"],
+                                )
+                            journal.mark_done("publish", dataset["name"])
+
+                    if generate_country_datasets:
+                        iso3s = []
+                        for iso3 in ghsl.global_boundaries:
+                            country_data = journal.get("process", f"ghsl/{iso3}")
+                            if country_data is None:
+                                iso3s.append(iso3)
+                            elif country_data:
+                                ghsl.country_data[iso3] = country_data
+                                submit_ghsl_dataset(iso3)
+                        for iso3, country_data in process_in_pool(
+                            ghsl, "process", iso3s, processes
+                        ):
+                            journal.mark_done(
+                                "process", f"ghsl/{iso3}", country_data or {}
+                            )
+                            if not country_data:
+                                continue
+                            ghsl.country_data[iso3] = country_data
+                            submit_ghsl_dataset(iso3)
+
+            if drought_updated and generate_country_datasets:
+                drought.record_processed()
+            if run_report:
+                run_report.save(_REPORT_FILE)
+                run_report.log_summary()
+
+
+def get_processed_drought_files(
+    journal: RunJournal, data_type: str, iso3: str, file_paths: Dict
+) -> Optional[List[str]]:
+    # A country is processed again on resume if the global files have changed
+    # since, e.g. when a new dekad has been downloaded
+    processed = journal.get("process", f"{data_type}/{iso3}")
+    if processed is None or processed["global_files"] != sorted(file_paths):
+        return None
+    return processed["country_files"]
+
+
+def get_drought_publish_steps(
+    drought: Drought,
+    journal: RunJournal,
+    report: Optional[RunReport],
+    batch: str,
+    dataset: Dataset,
+    iso3: str,
+    data_type: str,
+) -> List[Callable]:
+    # The publisher retries each step on its own so files are not uploaded
+    # again if only cleaning up the resources fails
+    def create() -> None:
+        _create_in_hdx(dataset, iso3, report, batch, False)
+
+    def clean_up() -> None:
+        drought.clean_up_resources(iso3, dataset, data_type)
+
+    def record() -> None:
+        drought.record_published(iso3, data_type)
+        journal.mark_done("publish", dataset["name"])
+
+    return [create, clean_up, record]
+
+
+def get_ghsl_publish_steps(
+    ghsl: GHSL,
+    journal: RunJournal,
+    report: Optional[RunReport],
+    batch: str,
+    dataset: Dataset,
+    iso3: str,
+) -> List[Callable]:
+    def create() -> None:
+        # Unchanged rasters are left out of the dataset so other resources
+        # are only removed when every raster is included
+        all_resources = len(dataset.get_resources()) == len(ghsl.country_data[iso3])
+        _create_in_hdx(dataset, iso3, report, batch, all_resources)
+
+    def record() -> None:
+        ghsl.record_published(iso3)
+        journal.mark_done("publish", dataset["name"])
+
+    return [create, record]
+
+
+def _create_in_hdx(
+    dataset: Dataset,
+    iso3: str,
+    report: Optional[RunReport],
+    batch: str,
+    remove_additional_resources: bool,
+) -> None:
+    with stage(report, "publish", iso3) as record:
+        dataset.create_in_hdx(
+            remove_additional_resources=remove_additional_resources,
+            match_resource_order=False,
+            updated_by_script=_UPDATED_BY_SCRIPT,
+            batch=batch,
+        )
+        _record_uploads(record, dataset)
+
+
+def _record_uploads(record: StageRecord, dataset: Dataset) -> None:
+    for resource in dataset.get_resources():
+        file_to_upload = resource.get_file_to_upload()
+        if file_to_upload:
+            record.add_file(file_to_upload)
 
 
 if __name__ == "__main__":
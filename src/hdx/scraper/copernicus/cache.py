@@ -0,0 +1,182 @@
+import logging
+from contextlib import contextmanager
+from hashlib import sha256
+from json import dump, load
+from os import makedirs, replace
+from os.path import dirname, exists, join
+from typing import IO, Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from geopandas import GeoDataFrame, read_file
+from numpy import array, ndarray, packbits, savez, unpackbits, zeros
+from numpy import load as load_array
+from rasterio.io import DatasetReader
+from rasterio.windows import Window
+
+from hdx.scraper.copernicus.raster import get_mask, simplify_geometry
+
+logger = logging.getLogger(__name__)
+
+
+class GeometryCache:
+    # Prepared boundaries and tiles by country are kept between runs in files
+    # named by a key made from the inputs they were derived from
+    def __init__(self, folder: str):
+        self._folder = folder
+        self.boundary_key = None
+        makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def get_key(*parts: str) -> str:
+        return sha256("|".join(str(p) for p in parts).encode()).hexdigest()[:16]
+
+    def load_boundaries(self, key: str) -> Optional[Tuple[GeoDataFrame, GeoDataFrame]]:
+        self.boundary_key = key
+        file_path = join(self._folder, f"boundaries_{key}.gpkg")
+        if not exists(file_path):
+            return None
+        logger.info(f"Using cached boundaries {file_path}")
+        lyr_wgs = read_file(file_path, layer="wgs84")
+        lyr_mollweide = read_file(file_path, layer="mollweide")
+        return lyr_wgs, lyr_mollweide
+
+    def save_boundaries(
+        self, key: str, lyr_wgs: GeoDataFrame, lyr_mollweide: GeoDataFrame
+    ) -> None:
+        self.boundary_key = key
+        file_path = join(self._folder, f"boundaries_{key}.gpkg")
+        temp_path = join(self._folder, f"boundaries_{key}_temp.gpkg")
+        lyr_wgs.to_file(temp_path, layer="wgs84", driver="GPKG", promote_to_multi=False)
+        lyr_mollweide.to_file(
+            temp_path, layer="mollweide", driver="GPKG", promote_to_multi=False
+        )
+        replace(temp_path, file_path)
+
+    def load_tiles(self, key: str) -> Optional[Dict[str, Set[str]]]:
+        file_path = join(self._folder, f"tiles_{key}.json")
+        if not exists(file_path):
+            return None
+        logger.info(f"Using cached tiles {file_path}")
+        with open(file_path) as f:
+            tiles_by_country = load(f)
+        return {iso3: set(tiles) for iso3, tiles in tiles_by_country.items()}
+
+    def save_tiles(self, key: str, tiles_by_country: Dict[str, Set[str]]) -> None:
+        save_json(
+            join(self._folder, f"tiles_{key}.json"),
+            {iso3: sorted(tiles) for iso3, tiles in tiles_by_country.items()},
+        )
+
+
+class ValidatorCache:
+    # Values derived from remote files, such as parsed listings or sizes,
+    # kept between runs with the validators needed to revalidate them with
+    # conditional requests
+    def __init__(self, file_path: str):
+        self._file_path = file_path
+        self._entries = {}
+        if exists(file_path):
+            with open(file_path) as f:
+                self._entries = load(f)
+
+    def get(self, url: str) -> Optional[Dict]:
+        return self._entries.get(url)
+
+    def set(
+        self,
+        url: str,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        **values: Any,
+    ) -> None:
+        self._entries[url] = {"etag": etag, "last_modified": last_modified, **values}
+        save_json(self._file_path, self._entries)
+
+
+class MaskIndex:
+    # Crop window and pixel mask of each country on a raster grid. Every
+    # raster with the same grid shares them so each country is only
+    # rasterized once. They are kept between runs if a folder is given, in
+    # files named by a key made from the grid and the boundaries.
+    def __init__(self, folder: Optional[str] = None, boundary_key: str = ""):
+        self._folder = folder
+        self._boundary_key = boundary_key
+        self._masks = {}
+
+    def get(
+        self,
+        dataset: DatasetReader,
+        iso3: str,
+        geometry: List[Dict],
+        tolerance: float = 0,
+    ) -> Optional[Tuple[Window, ndarray]]:
+        # None if the country is not on the grid. The geometry is simplified
+        # for the pixel size of the grid only when its mask is computed.
+        crs = dataset.crs.to_wkt() if dataset.crs else None
+        grid_key = GeometryCache.get_key(
+            self._boundary_key,
+            crs,
+            tuple(dataset.transform),
+            dataset.shape,
+            tolerance,
+        )
+        key = (grid_key, iso3)
+        if key not in self._masks:
+            packed = self._load(grid_key, iso3)
+            if packed is None:
+                geometry = simplify_geometry(geometry, min(dataset.res), tolerance)
+                packed = _pack_mask(dataset, geometry)
+                self._save(grid_key, iso3, packed)
+            self._masks[key] = packed
+        window, shape_mask = self._masks[key]
+        if not window[2]:
+            return None
+        col_off, row_off, width, height = (int(o) for o in window)
+        shape_mask = unpackbits(shape_mask, count=width * height)
+        shape_mask = shape_mask.reshape(height, width).astype(bool)
+        return Window(col_off, row_off, width, height), shape_mask
+
+    def _get_path(self, grid_key: str, iso3: str) -> str:
+        return join(self._folder, f"masks_{grid_key}", f"{iso3}.npz")
+
+    def _load(self, grid_key: str, iso3: str) -> Optional[Tuple[ndarray, ndarray]]:
+        if not self._folder:
+            return None
+        file_path = self._get_path(grid_key, iso3)
+        if not exists(file_path):
+            return None
+        with load_array(file_path) as masks:
+            return masks["window"], masks["mask"]
+
+    def _save(self, grid_key: str, iso3: str, packed: Tuple[ndarray, ndarray]) -> None:
+        if not self._folder:
+            return
+        with open_replacing(self._get_path(grid_key, iso3), "wb") as f:
+            savez(f, window=packed[0], mask=packed[1])
+
+
+@contextmanager
+def open_replacing(file_path: str, mode: str = "w") -> Iterator[IO]:
+    # Written to a temporary file that then replaces the file, so a run that
+    # stops part way through never leaves a partly written file
+    folder = dirname(file_path)
+    if folder:
+        makedirs(folder, exist_ok=True)
+    temp_path = f"{file_path}.temp"
+    with open(temp_path, mode) as f:
+        yield f
+    replace(temp_path, file_path)
+
+
+def save_json(file_path: str, data: Any) -> None:
+    with open_replacing(file_path) as f:
+        dump(data, f, indent=1, sort_keys=True)
+
+
+def _pack_mask(dataset: DatasetReader, geometry: List[Dict]) -> Tuple[ndarray, ndarray]:
+    # A country that is not on the grid has a window of zero width
+    try:
+        window, shape_mask = get_mask(dataset, geometry)
+    except ValueError:
+        return zeros(4, dtype="int64"), zeros(0, dtype="uint8")
+    offsets = (window.col_off, window.row_off, window.width, window.height)
+    return array([int(o) for o in offsets]), packbits(shape_mask, axis=None)
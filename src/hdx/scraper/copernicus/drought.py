@@ -2,12 +2,12 @@
 """copernicus scraper"""
 
 import logging
+from contextlib import ExitStack
 from datetime import datetime, timedelta
-from json import loads
-from os import mkdir
+from hashlib import sha256
+from json import dumps, loads
 from os.path import basename, join
-from shutil import copy
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 from zipfile import ZipFile
 
 import rasterio
@@ -18,10 +18,24 @@ from hdx.data.dataset import Dataset
 from hdx.data.resource import Resource
 from hdx.location.country import Country
 from hdx.utilities.dateparse import parse_date
-from hdx.utilities.dictandlist import dict_of_lists_add
+from hdx.utilities.dictandlist import dict_of_dicts_add, dict_of_lists_add
 from hdx.utilities.retriever import Retrieve
-from rasterio.mask import mask
+from numpy import array, lexsort
+from shapely import STRtree, get_parts, intersection, make_valid, union_all
+from shapely.geometry import mapping, shape
+from shapely.geometry.base import BaseGeometry
 
+from hdx.scraper.copernicus.cache import MaskIndex, ValidatorCache
+from hdx.scraper.copernicus.journal import RunJournal
+from hdx.scraper.copernicus.manifest import Manifest
+from hdx.scraper.copernicus.raster import (
+    check_output_profile,
+    clip_raster,
+    get_content_hash,
+    get_zip_path,
+    write_to_zip,
+)
+from hdx.scraper.copernicus.report import RunReport, stage
 from hdx.scraper.copernicus.utilities import get_lines
 
 logger = logging.getLogger(__name__)
@@ -33,19 +47,42 @@ class Drought:
         configuration: Configuration,
         retriever: Retrieve,
         global_boundaries: GeoDataFrame,
+        manifest: Optional[Manifest] = None,
+        listing_cache: Optional[ValidatorCache] = None,
+        journal: Optional[RunJournal] = None,
+        report: Optional[RunReport] = None,
+        mask_index: Optional[MaskIndex] = None,
     ):
+        check_output_profile(configuration["output_profile"])
         self._configuration = configuration
         self._retriever = retriever
+        self._manifest = manifest
+        self._listing_cache = listing_cache
+        self._journal = journal
+        self.report = report
+        self._mask_index = mask_index or MaskIndex()
         self._temp_folder = retriever.temp_dir
         self.global_boundaries = {}
         self.global_data = {}
         self.downloaded_data = {}
         self.country_data = {}
+        self.country_checksums = {}
         self.dates = {}
         layer = loads(global_boundaries.to_json())["features"]
         for row in layer:
             iso = row["properties"]["ISO_3"]
             self.global_boundaries[iso] = [row["geometry"]]
+        self._boundary_geometries = dict(
+            zip(global_boundaries["ISO_3"], global_boundaries.geometry.values)
+        )
+
+    def __getstate__(self) -> Dict:
+        # Worker processes only clip rasters so the retriever is left behind
+        state = self.__dict__.copy()
+        state["_retriever"] = None
+        state["_manifest"] = None
+        state["_journal"] = None
+        return state
 
     def get_data(self, download_country: bool, force_update: bool = False) -> bool:
         file_patterns = self._configuration["file_patterns"]
@@ -55,13 +92,28 @@ class Drought:
             dataset_files = _get_dataset_files(
                 self._configuration["dataset_info"][data_type]["name"]
             )
+            published_files = set(dataset_files)
+            if self._manifest and file_type == "GeoTIFF":
+                published_files = self._manifest.get_files(data_type)
+                if published_files is None:
+                    # Files in the global dataset before the manifest was kept
+                    # have already been published for every country
+                    published_files = set(dataset_files)
+                    self._manifest.add_files(data_type, published_files)
             if force_update:
                 dataset_files = []
+                published_files = set()
             base_url = f"{self._configuration['base_url']}{file_pattern}/"
-            lines = get_lines(self._retriever, base_url, f"drought_{data_type}_ftp.txt")
+            lines = get_lines(
+                self._retriever,
+                base_url,
+                f"drought_{data_type}_ftp.txt",
+                self._listing_cache,
+                report=self.report,
+                timeout=self._configuration["listing_timeout"],
+            )
             subfolders = []
-            for line in lines:
-                subfolder = line.get("href")
+            for subfolder in lines:
                 if "ver" not in subfolder:
                     continue
                 subfolders.append(subfolder)
@@ -71,10 +123,12 @@ class Drought:
                     self._retriever,
                     f"{base_url}{subfolder}",
                     filename=f"drought_{data_type}_{subfolder.replace('/', '')}.txt",
+                    listing_cache=self._listing_cache,
+                    report=self.report,
+                    timeout=self._configuration["listing_timeout"],
                 )
-                for sub_line in sub_lines:
+                for subsubfolder in sub_lines:
                     files_found = False
-                    subsubfolder = sub_line.get("href")
                     if not subsubfolder.endswith(".zip"):
                         continue
                     files_found = True
@@ -84,14 +138,10 @@ class Drought:
                     zip_url = f"{base_url}{subfolder}{subsubfolder}"
                     dict_of_lists_add(self.global_data, data_type, zip_url)
                     if file_type == "GeoJSON":
-                        file_path = self._retriever.download_file(
-                            zip_url, filename=basename(zip_url)
-                        )
+                        file_path = self._download_file(zip_url)
                         dict_of_lists_add(self.downloaded_data, data_type, file_path)
-                    elif download_country and subsubfolder not in dataset_files:
-                        file_path = self._retriever.download_file(
-                            zip_url, filename=basename(zip_url)
-                        )
+                    elif download_country and subsubfolder not in published_files:
+                        file_path = self._download_file(zip_url)
                         dict_of_lists_add(self.downloaded_data, data_type, file_path)
                 return files_found
 
@@ -110,78 +160,154 @@ class Drought:
             global_data = [basename(f) for f in self.global_data.get(data_type, [])]
             if sorted(global_data) != sorted(dataset_files):
                 updated = True
+            # GeoJSON files are downloaded on every run so only new rasters,
+            # which are not in the manifest, count as an update
+            if file_type == "GeoTIFF" and self.downloaded_data.get(data_type):
+                updated = True
         return updated
 
-    def unzip_data(self, data_type: str) -> Dict:
+    def _download_file(self, url: str) -> str:
+        if self._journal:
+            file_path = self._journal.get("download", url)
+            if file_path:
+                return file_path
+        with stage(self.report, "download") as record:
+            file_path = self._retriever.download_file(url, filename=basename(url))
+            record.add_file(file_path, written=False)
+        if self._journal:
+            self._journal.mark_done("download", url, file_path)
+        return file_path
+
+    def list_data(self, data_type: str) -> Dict:
+        # Files are read from inside the downloaded zips so nothing is extracted
         file_paths = {}
-        file_type = self._configuration["file_types"][data_type]
-        if file_type == "GeoJSON":
-            return file_paths
         for zip_file_path in self.downloaded_data.get(data_type, []):
-            zip_folder = join(self._temp_folder, basename(zip_file_path)[:-4])
-            mkdir(zip_folder)
             with ZipFile(zip_file_path, "r") as z:
-                file_list = z.namelist()
-                z.extractall(zip_folder)
-            file_paths[zip_folder] = file_list
+                file_paths[zip_file_path] = z.namelist()
         return file_paths
 
-    def process(self, iso3: str, file_paths: Dict) -> Dict | None:
+    def process(self, iso3: str, data_type: str, file_paths: Dict) -> List | None:
+        return self.process_countries([iso3], data_type, file_paths).get(iso3)
+
+    def process_countries(
+        self, iso3s: List[str], data_type: str, file_paths: Dict
+    ) -> Dict:
+        # Each global raster or GeoJSON is read once and clipped for all
+        # countries
         if len(file_paths) == 0:
-            return None
+            return {}
+        iso3s = [iso3 for iso3 in iso3s if self._include_country(iso3)]
+        output_profile = self._configuration["output_profile"]
+        country_data = self.country_data.setdefault(data_type, {})
+        boundary_tree = None
+        processed_iso3s = set()
+        for zip_file_path, files in file_paths.items():
+            folder = basename(zip_file_path)[:-4]
+            # Country zips are built as each file is clipped and the files
+            # shared by all countries are read once
+            with ZipFile(zip_file_path, "r") as z:
+                shared_files = {
+                    basename(f): z.read(f)
+                    for f in files
+                    if not f.endswith((".tif", ".json"))
+                }
+            country_zips = {}
+            with ExitStack() as stack:
+
+                def get_country_zip(iso3: str) -> ZipFile:
+                    if iso3 not in country_zips:
+                        country_zip = join(
+                            self._temp_folder, f"{iso3.lower()}_{folder}.zip"
+                        )
+                        country_zips[iso3] = stack.enter_context(
+                            ZipFile(country_zip, "w")
+                        )
+                    return country_zips[iso3]
+
+                for file_name in files:
+                    if file_name.endswith(".json"):
+                        if boundary_tree is None:
+                            boundary_tree = STRtree(
+                                [self._boundary_geometries[iso3] for iso3 in iso3s]
+                            )
+                        self._process_clusters(
+                            zip_file_path,
+                            file_name,
+                            iso3s,
+                            boundary_tree,
+                            get_country_zip,
+                        )
+                        continue
+                    if not file_name.endswith(".tif"):
+                        continue
+                    logger.info(f"Processing {file_name} for {len(iso3s)} countries")
+                    raster_path = get_zip_path(zip_file_path, file_name)
+                    with rasterio.open(raster_path, "r") as global_raster:
+                        for iso3 in iso3s:
+                            with stage(self.report, "clip", iso3) as record:
+                                country_mask = self._mask_index.get(
+                                    global_raster,
+                                    iso3,
+                                    self.global_boundaries[iso3],
+                                    self._configuration["simplify_tolerance"],
+                                )
+                                if not country_mask:
+                                    continue
+                                mask_raster, mask_meta = clip_raster(
+                                    global_raster, *country_mask
+                                )
+                                record.add(bytes_out=mask_raster.nbytes)
+                            country_zip = get_country_zip(iso3)
+                            with stage(self.report, "compress", iso3) as record:
+                                write_to_zip(
+                                    country_zip,
+                                    basename(file_name),
+                                    mask_raster,
+                                    mask_meta,
+                                    output_profile,
+                                )
+                                info = country_zip.getinfo(basename(file_name))
+                                record.add(mask_raster.nbytes, info.file_size, 1)
+                for z in country_zips.values():
+                    for shared_name, contents in shared_files.items():
+                        z.writestr(shared_name, contents)
+            for iso3 in iso3s:
+                if iso3 not in country_zips:
+                    logger.info(f"No data for {iso3} in {folder}, skipping")
+                    continue
+                dict_of_lists_add(country_data, iso3, country_zips[iso3].filename)
+                processed_iso3s.add(iso3)
+        return {iso3: country_data[iso3] for iso3 in iso3s if iso3 in processed_iso3s}
+
+    def _process_clusters(
+        self,
+        zip_file_path: str,
+        file_name: str,
+        iso3s: List[str],
+        boundary_tree: STRtree,
+        get_country_zip: Callable[[str], ZipFile],
+    ) -> None:
+        with stage(self.report, "clip") as record:
+            with ZipFile(zip_file_path, "r") as z:
+                contents = z.read(file_name)
+            record.add(bytes_in=len(contents))
+            collections = _clip_features(loads(contents), iso3s, boundary_tree)
+        for iso3, collection in collections.items():
+            with stage(self.report, "compress", iso3) as record:
+                contents = dumps(collection)
+                country_zip = get_country_zip(iso3)
+                country_zip.writestr(basename(file_name), contents)
+                info = country_zip.getinfo(basename(file_name))
+                record.add(len(contents), info.file_size, 1)
+
+    def _include_country(self, iso3: str) -> bool:
         if iso3 in self._configuration["skip_countries"]:
-            return None
-        logger.info(f"Processing {iso3}")
+            return False
         country_name = Country.get_country_name_from_iso3(iso3)
         if not country_name:
             logger.error(f"Couldn't find country {iso3}, skipping")
-            return None
-        iso_geometry = self.global_boundaries[iso3]
-        for folder, files in file_paths.items():
-            country_folder = join(
-                self._temp_folder, f"{iso3.lower()}_{basename(folder)}"
-            )
-            mkdir(country_folder)
-            country_files = []
-            for raster_name in files:
-                raster_path = join(folder, basename(raster_name))
-                country_file = join(country_folder, basename(raster_name))
-                if not raster_name.endswith(".tif"):
-                    copy(raster_path, country_folder)
-                    country_files.append(country_file)
-                    continue
-                try:
-                    with rasterio.open(raster_path, "r") as global_raster:
-                        mask_raster, mask_transform = mask(
-                            global_raster, iso_geometry, all_touched=True, crop=True
-                        )
-                        mask_meta = global_raster.meta.copy()
-                except ValueError:
-                    continue
-                mask_meta.update(
-                    {
-                        "height": mask_raster.shape[1],
-                        "width": mask_raster.shape[2],
-                        "transform": mask_transform,
-                    }
-                )
-                with rasterio.open(
-                    country_file, "w", **mask_meta, compress="LZW"
-                ) as dest:
-                    dest.write(mask_raster)
-                country_files.append(country_file)
-            tifs = [f for f in country_files if f.endswith(".tif")]
-            if len(tifs) == 0:
-                logger.info(f"No data for {iso3}, skipping")
-                return None
-            country_zip = join(
-                self._temp_folder, f"{iso3.lower()}_{basename(folder)}.zip"
-            )
-            with ZipFile(country_zip, "w") as z:
-                for country_file in country_files:
-                    z.write(country_file, basename(country_file))
-            dict_of_lists_add(self.country_data, iso3, country_zip)
-        return self.country_data[iso3]
+            return False
+        return True
 
     def generate_global_dataset(self, data_type: str) -> Optional[Dataset]:
         dataset_info = self._configuration["dataset_info"][data_type]
@@ -254,8 +380,19 @@ class Drought:
         dataset.add_tags(dataset_tags)
         dataset.add_country_location(iso3)
 
-        file_paths = sorted(self.country_data[iso3], reverse=True)
+        file_type = self._configuration["file_types"][data_type]
+        file_paths = sorted(self.country_data[data_type][iso3], reverse=True)
+        checksums = {}
         for file_path in file_paths:
+            # Resources unchanged since they were last published are left alone
+            checksum = _get_zip_checksum(file_path)
+            if self._manifest:
+                published_checksum = self._manifest.get_checksum(
+                    data_type, iso3, basename(file_path)
+                )
+                if checksum == published_checksum:
+                    continue
+            checksums[basename(file_path)] = checksum
             start_date, end_date = _parse_date(basename(file_path))
             end_date = _parse_dekad(end_date)
             resource = Resource(
@@ -264,28 +401,58 @@ class Drought:
                     "description": f"Data from {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}",
                 }
             )
-            resource.set_format("GeoTIFF")
+            resource.set_format(file_type)
             resource.set_file_to_upload(file_path)
             dataset.add_update_resource(resource)
 
+        if not checksums:
+            logger.info(f"No changed resources for {iso3}, skipping")
+            return None
+        dict_of_dicts_add(self.country_checksums, data_type, iso3, checksums)
         return dataset
 
-    def clean_up_resources(self, iso3: str, dataset_name: str, data_type: str) -> None:
-        # remove any resources that are not in the global data list
-        global_data = [
+    def record_published(self, iso3: str, data_type: str) -> None:
+        if not self._manifest:
+            return
+        checksums = self.country_checksums[data_type][iso3]
+        self._manifest.add_checksums(data_type, iso3, checksums)
+
+    def record_processed(self) -> None:
+        # Only called once every country has been published so that files are
+        # processed again if the run fails part way through
+        if not self._manifest:
+            return
+        for data_type, file_paths in self.downloaded_data.items():
+            if self._configuration["file_types"][data_type] != "GeoTIFF":
+                continue
+            self._manifest.add_files(data_type, {basename(f) for f in file_paths})
+
+    def clean_up_resources(self, iso3: str, dataset: Dataset, data_type: str) -> None:
+        # Uses the resources returned when the dataset was created in HDX so
+        # only deletion and reordering need calls
+        global_data = {
             f"{iso3.lower()}_{basename(f)}" for f in self.global_data[data_type]
-        ]
-        dataset = Dataset.read_from_hdx(dataset_name)
+        }
         resources = dataset.get_resources()
-        for resource in resources:
-            if resource["name"] not in global_data:
-                resource.delete_from_hdx()
+        # remove any resources that are not in the global data list
+        resources_to_delete = [
+            i for i, r in enumerate(resources) if r["name"] not in global_data
+        ]
+        if resources_to_delete:
+            revise_filter = [f"-resources__{i}" for i in reversed(resources_to_delete)]
+            revised = Dataset.revise({"id": dataset["id"]}, filter=revise_filter)
+            # The dataset is kept as it is in HDX so a retry starts from there
+            dataset.data = revised.data
+            dataset.data["resources"] = [r.data for r in revised.get_resources()]
+            dataset.init_resources()
+            dataset.separate_resources()
+            resources = dataset.get_resources()
         # reorder resources
-        dataset = Dataset.read_from_hdx(dataset_name)
-        resources = dataset.get_resources()
-        resources = sorted(resources, key=lambda d: d["name"], reverse=True)
         resource_ids = [resource["id"] for resource in resources]
-        dataset.reorder_resources(resource_ids)
+        resources = sorted(resources, key=lambda d: d["name"], reverse=True)
+        sorted_ids = [resource["id"] for resource in resources]
+        if sorted_ids != resource_ids:
+            dataset.reorder_resources(sorted_ids)
 
 
 def _get_dataset_files(dataset_name: str) -> List:
@@ -296,6 +463,63 @@ def _get_dataset_files(dataset_name: str) -> List:
     return resource_names
 
 
+def _clip_features(
+    collection: Dict, iso3s: List[str], boundary_tree: STRtree
+) -> Dict[str, Dict]:
+    # Features are matched to the countries they overlap with the spatial
+    # index so each one is only clipped to those countries. Features keep the
+    # order they have in the global file.
+    features = [f for f in collection["features"] if f["geometry"]]
+    if not features:
+        return {}
+    geometries = make_valid(array([shape(f["geometry"]) for f in features]))
+    feature_indices, country_indices = boundary_tree.query(
+        geometries, predicate="intersects"
+    )
+    order = lexsort((country_indices, feature_indices))
+    feature_indices = feature_indices[order]
+    country_indices = country_indices[order]
+    clipped = intersection(
+        geometries[feature_indices], boundary_tree.geometries[country_indices]
+    )
+    collections = {}
+    for feature_index, country_index, geometry in zip(
+        feature_indices, country_indices, clipped
+    ):
+        # Features that only touch a country along its border are left out
+        geometry = _get_polygons(geometry)
+        if geometry.is_empty:
+            continue
+        iso3 = iso3s[country_index]
+        if iso3 not in collections:
+            collections[iso3] = dict(collection, features=[])
+        feature = dict(features[feature_index], geometry=mapping(geometry))
+        collections[iso3]["features"].append(feature)
+    return collections
+
+
+def _get_polygons(geometry: BaseGeometry) -> BaseGeometry:
+    if geometry.geom_type in ("Polygon", "MultiPolygon"):
+        return geometry
+    return union_all(
+        [g for g in get_parts(geometry) if g.geom_type in ("Polygon", "MultiPolygon")]
+    )
+
+
+def _get_zip_checksum(file_path: str) -> str:
+    # Zip files store modification times so the checksum is made from the
+    # content hash of each raster and the CRC of each other file in the zip
+    members = []
+    with ZipFile(file_path, "r") as z:
+        for info in z.infolist():
+            if info.filename.endswith(".tif"):
+                content_hash = get_content_hash(get_zip_path(file_path, info.filename))
+                members.append(f"{info.filename}:{content_hash}")
+            else:
+                members.append(f"{info.filename}:{info.CRC}:{info.file_size}")
+    return sha256("|".join(sorted(members)).encode()).hexdigest()
+
+
 def _parse_date(file_name: str) -> Tuple:
     file_name = file_name.split("_")
     if len(file_name) == 1:
@@ -4,24 +4,40 @@
 import logging
 import re
 from json import loads
-from os.path import join
-from typing import Dict, List, Optional
+from os.path import basename, join
+from typing import Dict, List, Optional, Set
 from zipfile import ZipFile
 
-import rasterio
-from geopandas import GeoDataFrame, overlay, read_file
+from geopandas import GeoDataFrame, read_file
 from hdx.api.configuration import Configuration
 from hdx.data.dataset import Dataset
 from hdx.data.resource import Resource
 from hdx.location.country import Country
-from hdx.utilities.dictandlist import dict_of_dicts_add, dict_of_lists_add
+from hdx.utilities.dictandlist import (
+    dict_of_dicts_add,
+    dict_of_lists_add,
+    dict_of_sets_add,
+)
 from hdx.utilities.retriever import Retrieve
-from rasterio.mask import mask
-from rasterio.merge import merge
-from requests import head
+from shapely import touches
 from slugify import slugify
 
-from hdx.scraper.copernicus.utilities import get_lines
+from hdx.scraper.copernicus.cache import GeometryCache, ValidatorCache
+from hdx.scraper.copernicus.journal import RunJournal
+from hdx.scraper.copernicus.manifest import Manifest
+from hdx.scraper.copernicus.raster import (
+    check_output_profile,
+    clip_mosaic,
+    get_content_hash,
+    get_zip_path,
+    simplify_geometry,
+)
+from hdx.scraper.copernicus.report import RunReport, stage
+from hdx.scraper.copernicus.utilities import (
+    download_files,
+    get_file_sizes,
+    get_lines,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -35,9 +51,22 @@ class GHSL:
         configuration: Configuration,
         retriever: Retrieve,
         global_boundaries: GeoDataFrame,
+        cache: Optional[GeometryCache] = None,
+        listing_cache: Optional[ValidatorCache] = None,
+        journal: Optional[RunJournal] = None,
+        manifest: Optional[Manifest] = None,
+        size_cache: Optional[ValidatorCache] = None,
+        report: Optional[RunReport] = None,
     ):
+        check_output_profile(configuration["output_profile"])
         self._configuration = configuration
         self._retriever = retriever
+        self._cache = cache
+        self._listing_cache = listing_cache
+        self._journal = journal
+        self._manifest = manifest
+        self._size_cache = size_cache
+        self.report = report
         self._temp_folder = retriever.temp_dir
         self.global_boundaries_original = global_boundaries
         self.tiling_schema = None
@@ -46,8 +75,19 @@ class GHSL:
         self.tiles_by_country = {}
         self.latest_data = {}
         self.country_data = {}
+        self.country_checksums = {}
         self.data_year = {}
 
+    def __getstate__(self) -> Dict:
+        # The retriever and its session are not needed to process countries
+        state = self.__dict__.copy()
+        state["_retriever"] = None
+        state["_cache"] = None
+        state["_journal"] = None
+        state["_manifest"] = None
+        state["_size_cache"] = None
+        return state
+
     def get_tiling_schema(self):
         url = self._configuration["tiling_schema"]["url"]
         zip_file_path = self._retriever.download_file(url)
@@ -64,27 +104,71 @@ class GHSL:
         self.tiling_schema = lyr
 
     def get_boundaries(self) -> List:
-        joined_lyr = overlay(
-            self.tiling_schema, self.global_boundaries_original, how="intersection"
-        )
-        for i, row in joined_lyr.iterrows():
-            iso = row["ISO_3"]
-            dict_of_lists_add(self.tiles_by_country, iso, row["tile_id"])
+        tiles_key = None
+        if self._cache and self._cache.boundary_key:
+            tiles_key = self._cache.get_key(
+                self._cache.boundary_key, self._configuration["tiling_schema"]["url"]
+            )
+            tiles_by_country = self._cache.load_tiles(tiles_key)
+            if tiles_by_country is not None:
+                self.tiles_by_country = tiles_by_country
+        if not self.tiles_by_country:
+            if self.tiling_schema is None:
+                self.get_tiling_schema()
+            # Tiles that only touch a country along an edge are left out, as
+            # they were when tiles were found by overlay
+            tile_geometries = self.tiling_schema.geometry.values
+            country_geometries = self.global_boundaries_original.geometry.values
+            tile_indices, country_indices = (
+                self.global_boundaries_original.sindex.query(
+                    tile_geometries, predicate="intersects"
+                )
+            )
+            overlaps = ~touches(
+                tile_geometries[tile_indices], country_geometries[country_indices]
+            )
+            isos = self.global_boundaries_original["ISO_3"].values
+            tile_ids = self.tiling_schema["tile_id"].values
+            for tile_index, country_index in zip(
+                tile_indices[overlaps], country_indices[overlaps]
+            ):
+                dict_of_sets_add(
+                    self.tiles_by_country, isos[country_index], tile_ids[tile_index]
+                )
+            if tiles_key:
+                self._cache.save_tiles(tiles_key, self.tiles_by_country)
         layer = loads(self.global_boundaries_original.to_json())["features"]
         for row in layer:
             iso = row["properties"]["ISO_3"]
             self.global_boundaries[iso] = [row["geometry"]]
         return list(self.global_boundaries.keys())
 
-    def get_data(self, current_year: int, download_country: bool) -> bool:
+    def get_required_tiles(self) -> Set:
+        skip_countries = self._configuration["skip_countries"]
+        required_tiles = set()
+        for iso3, iso_tiles in self.tiles_by_country.items():
+            if iso3 in skip_countries:
+                continue
+            required_tiles.update(iso_tiles)
+        return required_tiles
+
+    def get_data(
+        self, current_year: int, download_country: bool, force_update: bool = False
+    ) -> bool:
         file_patterns = self._configuration["file_patterns"]
         dataset_dates = _get_ghs_dataset_dates(list(file_patterns.keys()))
         base_url = self._configuration["base_url"]
-        lines = get_lines(self._retriever, base_url, "ghsl_ftp.txt")
+        lines = get_lines(
+            self._retriever,
+            base_url,
+            "ghsl_ftp.txt",
+            self._listing_cache,
+            report=self.report,
+            timeout=self._configuration["listing_timeout"],
+        )
         for data_type, subfolder_pattern in file_patterns.items():
             subfolders = []
-            for line in lines:
-                subfolder = line.get("href")
+            for subfolder in lines:
                 if subfolder_pattern not in subfolder:
                     continue
                 subfolders.append(subfolder)
@@ -95,10 +179,12 @@ class GHSL:
                 self._retriever,
                 f"{base_url}{subfolder}",
                 filename=f"{subfolder.replace('/', '')}.txt",
+                listing_cache=self._listing_cache,
+                report=self.report,
+                timeout=self._configuration["listing_timeout"],
             )
             subsubfolders = []
-            for sub_line in sub_lines:
-                subsubfolder = sub_line.get("href")
+            for subsubfolder in sub_lines:
                 if not subsubfolder.endswith(f"{self._configuration['resolution']}/"):
                     continue
                 if "NRES" in subsubfolder:
@@ -108,7 +194,8 @@ class GHSL:
                 _DATA_YEAR_PATTERN, subsubfolders, current_year
             )
             if (
-                modeled_year == dataset_dates[data_type]["modeled"]
+                not force_update
+                and modeled_year == dataset_dates[data_type]["modeled"]
                 and year == dataset_dates[data_type]["estimated"]
             ):
                 return False
@@ -116,24 +203,51 @@ class GHSL:
             global_file = f"{base_url}{subfolder}{subsubfolder}V1-0/{subsubfolder.replace('/', '')}_V1_0.zip"
             self.global_data[data_type] = global_file
             if download_country:
+                if not self.global_boundaries:
+                    self.get_boundaries()
+                required_tiles = self.get_required_tiles()
                 tile_lines = get_lines(
                     self._retriever,
                     f"{base_url}{subfolder}{subsubfolder}V1-0/tiles/",
                     filename=f"{subsubfolder.replace('/', '')}.txt",
+                    listing_cache=self._listing_cache,
+                    report=self.report,
+                    timeout=self._configuration["listing_timeout"],
                 )
-                for tile_line in tile_lines:
-                    zip_file = tile_line.get("href")
+                zip_urls = []
+                for zip_file in tile_lines:
                     if ".zip" not in zip_file:
                         continue
-                    zip_url = (
+                    if _get_tile(zip_file) not in required_tiles:
+                        continue
+                    zip_urls.append(
                         f"{base_url}{subfolder}{subsubfolder}V1-0/tiles/{zip_file}"
                     )
-                    zip_file_path = self._retriever.download_file(zip_url)
-                    with ZipFile(zip_file_path, "r") as z:
-                        file_path = z.extract(f"{zip_file[:-4]}.tif", self._temp_folder)
-                    dict_of_lists_add(self.latest_data, data_type, file_path)
+                # Tiles downloaded before a failed run are not downloaded again
+                file_paths = {}
+                if self._journal:
+                    for zip_url in zip_urls:
+                        zip_file_path = self._journal.get("download", zip_url)
+                        if zip_file_path:
+                            file_paths[zip_url] = _get_tile_path(zip_url, zip_file_path)
+                zip_urls_to_download = [u for u in zip_urls if u not in file_paths]
+                downloaded_paths = download_files(
+                    self._retriever,
+                    zip_urls_to_download,
+                    self._configuration["download_workers"],
+                    self._get_tile_path,
+                    self.report,
+                )
+                file_paths.update(zip(zip_urls_to_download, downloaded_paths))
+                for zip_url in zip_urls:
+                    dict_of_lists_add(self.latest_data, data_type, file_paths[zip_url])
         return True
 
+    def _get_tile_path(self, zip_url: str, zip_file_path: str) -> str:
+        if self._journal:
+            self._journal.mark_done("download", zip_url, zip_file_path)
+        return _get_tile_path(zip_url, zip_file_path)
+
     def process(self, iso3: str) -> Dict | None:
         if iso3 in self._configuration["skip_countries"]:
             return None
@@ -142,46 +256,25 @@ class GHSL:
         if not country_name:
             logger.error(f"Couldn't find country {iso3}, skipping")
             return None
-        iso_geometry = self.global_boundaries[iso3]
+        iso_geometry = simplify_geometry(
+            self.global_boundaries[iso3],
+            self._configuration["resolution"],
+            self._configuration["simplify_tolerance"],
+        )
         iso_tiles = self.tiles_by_country[iso3]
         for data_type, raster_list in self.latest_data.items():
-            files_to_mosaic = []
-            for raster_file in raster_list:
-                tile = "_".join(raster_file.split(".")[0].split("_")[-2:])
-                if tile not in iso_tiles:
-                    continue
-                with rasterio.open(raster_file, "r") as dataset:
-                    mask_raster, mask_transform = mask(
-                        dataset, iso_geometry, all_touched=True, crop=True
-                    )
-                    mask_meta = dataset.meta.copy()
-                mask_meta.update(
-                    {
-                        "height": mask_raster.shape[1],
-                        "width": mask_raster.shape[2],
-                        "transform": mask_transform,
-                    }
+            files_to_mosaic = [r for r in raster_list if _get_tile(r) in iso_tiles]
+            file_name = basename(raster_list[0]).replace("GLOBE_", "")
+            file_name = "_".join(file_name.split("_")[:-2])
+            mosaic_file = join(self._temp_folder, f"{file_name}_{iso3}.tif")
+            with stage(self.report, "mosaic", iso3) as record:
+                clip_mosaic(
+                    files_to_mosaic,
+                    iso_geometry,
+                    mosaic_file,
+                    self._configuration["output_profile"],
                 )
-                country_file = raster_file.replace("GLOBE_", "")[:-4] + f"_{iso3}.tif"
-                with rasterio.open(
-                    country_file, "w", **mask_meta, compress="LZW"
-                ) as dest:
-                    dest.write(mask_raster)
-                open_file = rasterio.open(country_file)
-                files_to_mosaic.append(open_file)
-            mosaic_raster, mosaic_transform = merge(files_to_mosaic)
-            mosaic_meta = open_file.meta.copy()
-            mosaic_meta.update(
-                {
-                    "height": mosaic_raster.shape[1],
-                    "width": mosaic_raster.shape[2],
-                    "transform": mosaic_transform,
-                }
-            )
-            file_name = "_".join(raster_list[0].replace("GLOBE_", "").split("_")[:-2])
-            mosaic_file = f"{file_name}_{iso3}.tif"
-            with rasterio.open(mosaic_file, "w", **mosaic_meta, compress="LZW") as dest:
-                dest.write(mosaic_raster)
+                record.add_file(mosaic_file)
             dict_of_dicts_add(self.country_data, iso3, data_type, mosaic_file)
         return self.country_data[iso3]
 
@@ -213,9 +306,15 @@ class GHSL:
         ]
 
         resource_info = self._configuration["resource_info"]
+        file_sizes = get_file_sizes(
+            self._retriever,
+            list(self.global_data.values()),
+            self._configuration["download_workers"],
+            self._configuration["probe_timeout"],
+            self._size_cache,
+        )
         for data_type, file_url in self.global_data.items():
-            file_size = head(file_url).headers.get("Content-Length")
-            file_size = round(int(file_size) / (1024**3), 1)
+            file_size = round(file_sizes[file_url] / (1024**3), 1)
             resource_desc = resource_info[data_type]["description"].replace(
                 "YYYY", str(self.data_year[data_type])
             )
@@ -257,7 +356,18 @@ class GHSL:
         dataset.add_country_location(iso3)
 
         resource_info = self._configuration["resource_info"]
+        checksums = {}
         for data_type, file_to_upload in self.country_data[iso3].items():
+            # Rasters with the same pixels as when last published are left
+            # alone. Checksums are kept by epoch so that the epoch in the
+            # description is updated when it changes.
+            checksum = get_content_hash(file_to_upload)
+            key = f"{data_type}_{self.data_year[data_type]}"
+            if self._manifest:
+                published_checksum = self._manifest.get_checksum("ghsl", iso3, key)
+                if checksum == published_checksum:
+                    continue
+            checksums[key] = checksum
             resource_desc = resource_info[data_type]["description"].replace(
                 "YYYY", str(self.data_year[data_type])
             )
@@ -271,8 +381,17 @@ class GHSL:
             resource.set_file_to_upload(self.country_data[iso3][data_type])
             dataset.add_update_resource(resource)
 
+        if not checksums:
+            logger.info(f"No changed resources for {iso3}, skipping")
+            return None
+        self.country_checksums[iso3] = checksums
         return dataset
 
+    def record_published(self, iso3: str) -> None:
+        if not self._manifest:
+            return
+        self._manifest.add_checksums("ghsl", iso3, self.country_checksums[iso3])
+
 
 def _select_latest_data(
     pattern: str, files: List[str], max_year: Optional[int] = None
@@ -287,6 +406,15 @@ def _select_latest_data(
     return latest_data, max_year
 
 
+def _get_tile_path(zip_url: str, zip_file_path: str) -> str:
+    # Tiles are read from inside the downloaded zips so nothing is extracted
+    return get_zip_path(zip_file_path, f"{basename(zip_url)[:-4]}.tif")
+
+
+def _get_tile(file_name: str) -> str:
+    return "_".join(basename(file_name).split(".")[0].split("_")[-2:])
+
+
 def _get_ghs_dataset_dates(data_types: List[str]) -> Dict:
     dataset_dates = {}
     dataset = Dataset.read_from_hdx("global-human-settlement-layer-ghsl")
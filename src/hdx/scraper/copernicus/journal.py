@@ -0,0 +1,46 @@
+import logging
+from json import dumps, load, loads
+from os.path import exists
+from threading import Lock
+from typing import Any, Optional
+
+from hdx.scraper.copernicus.cache import save_json
+
+logger = logging.getLogger(__name__)
+
+
+class RunJournal:
+    # Stages completed during a run. It is kept in the temporary folder, which
+    # is only deleted when a run succeeds, so a failed run can be resumed
+    def __init__(self, file_path: str, resume: bool = False):
+        self._file_path = file_path
+        self._lock = Lock()
+        self._stages = {}
+        if resume and exists(file_path):
+            with open(file_path) as f:
+                self._stages = load(f)
+            logger.info(f"Resuming run from {file_path}")
+
+    def get(self, stage: str, key: str) -> Optional[Any]:
+        # Recorded files must still exist for a stage to count as completed
+        value = self._stages.get(stage, {}).get(key)
+        if value is None or not _files_exist(value):
+            return None
+        return value
+
+    def mark_done(self, stage: str, key: str, value: Any = True) -> None:
+        # Paths are stored as strings so they read back the same on resume
+        value = loads(dumps(value, default=str))
+        with self._lock:
+            self._stages.setdefault(stage, {})[key] = value
+            save_json(self._file_path, self._stages)
+
+
+def _files_exist(value: Any) -> bool:
+    if isinstance(value, str):
+        return exists(value)
+    if isinstance(value, list):
+        return all(_files_exist(v) for v in value)
+    if isinstance(value, dict):
+        return all(_files_exist(v) for v in value.values())
+    return True
@@ -0,0 +1,46 @@
+import logging
+from json import load
+from os.path import exists
+from threading import Lock
+from typing import Dict, Optional, Set
+
+from hdx.scraper.copernicus.cache import save_json
+
+logger = logging.getLogger(__name__)
+
+
+class Manifest:
+    # Record kept between runs of the global files that have been processed
+    # for every country and the checksum of each country resource published
+    def __init__(self, file_path: str):
+        self._file_path = file_path
+        self._lock = Lock()
+        self._data = {}
+        if exists(file_path):
+            with open(file_path) as f:
+                self._data = load(f)
+
+    def get_files(self, data_type: str) -> Optional[Set[str]]:
+        files = self._data.get(data_type, {}).get("files")
+        if files is None:
+            return None
+        return set(files)
+
+    def add_files(self, data_type: str, files: Set[str]) -> None:
+        with self._lock:
+            data = self._data.setdefault(data_type, {})
+            data["files"] = sorted(set(data.get("files", [])) | set(files))
+            self._save()
+
+    def get_checksum(self, data_type: str, iso3: str, name: str) -> Optional[str]:
+        countries = self._data.get(data_type, {}).get("countries", {})
+        return countries.get(iso3, {}).get(name)
+
+    def add_checksums(self, data_type: str, iso3: str, checksums: Dict) -> None:
+        with self._lock:
+            countries = self._data.setdefault(data_type, {}).setdefault("countries", {})
+            countries.setdefault(iso3, {}).update(checksums)
+            self._save()
+
+    def _save(self) -> None:
+        save_json(self._file_path, self._data)
@@ -0,0 +1,56 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+from multiprocessing import get_context
+from typing import Any, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Processor held by each worker process, set once when the worker starts
+_processor = None
+
+
+def _set_processor(processor: Any) -> None:
+    global _processor
+    _processor = processor
+
+
+def _call_processor(method: str, item: Any, *args: Any) -> Tuple[Any, Any]:
+    # Stages recorded by the worker are sent back with the result
+    result = getattr(_processor, method)(item, *args)
+    report = getattr(_processor, "report", None)
+    return result, report.pop() if report else None
+
+
+def process_in_pool(
+    processor: Any, method: str, items: List, processes: int, *args: Any
+) -> Iterator[Tuple[Any, Any]]:
+    # Results are yielded in the order of items as soon as they are available
+    if processes <= 1:
+        for item in items:
+            yield item, getattr(processor, method)(item, *args)
+        return
+    # Workers are spawned rather than forked as upload threads may be using
+    # the HDX session, and its locks and sockets, while the pool starts
+    executor = ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=get_context("spawn"),
+        initializer=_set_processor,
+        initargs=(processor,),
+    )
+    try:
+        futures = [
+            executor.submit(_call_processor, method, item, *args) for item in items
+        ]
+        for item, future in zip(items, futures):
+            result, records = future.result()
+            if records:
+                processor.report.merge(records)
+            yield item, result
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def split_list(items: List, number: int) -> List[List]:
+    size = max(ceil(len(items) / number), 1)
+    return [items[i : i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,123 @@
+import logging
+from queue import Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+class Publisher:
+    # Finished datasets are queued by the producer (country processing) and
+    # published by a bounded pool of worker threads so uploads overlap with
+    # processing of the next countries
+    def __init__(
+        self,
+        workers: int = 4,
+        queue_size: int = 8,
+        retries: int = 3,
+        backoff: float = 10,
+    ):
+        self._workers = workers
+        self._retries = retries
+        self._backoff = backoff
+        self._queue = Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = Lock()
+        self._errors = []
+        self._start = None
+        self._produce_start = None
+        self.stats = {
+            "produce": {"items": 0, "seconds": 0.0},
+            "publish": {"items": 0, "seconds": 0.0, "retries": 0, "failures": 0},
+        }
+
+    def __enter__(self) -> "Publisher":
+        self._start = monotonic()
+        self._produce_start = self._start
+        for _ in range(self._workers):
+            thread = Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.log_stats()
+        if exc_type is None and self._errors:
+            name, error = self._errors[0]
+            raise RuntimeError(
+                f"Publishing failed for {len(self._errors)} dataset(s), first was {name}"
+            ) from error
+
+    def submit_steps(self, name: str, steps: List[Callable]) -> None:
+        # Steps are run in order and each is retried on its own, so a step
+        # that fails does not repeat the steps that succeeded before it. Time
+        # since the last submit is the time the producer took to make this
+        # item, less any time spent waiting for a free slot in the queue
+        now = monotonic()
+        self._add_stat("produce", "items", 1)
+        self._add_stat("produce", "seconds", now - self._produce_start)
+        self._queue.put((name, steps))
+        self._produce_start = monotonic()
+
+    def log_stats(self) -> None:
+        elapsed = monotonic() - self._start
+        produce = self.stats["produce"]
+        publish = self.stats["publish"]
+        logger.info(
+            f"Produced {produce['items']} datasets in {produce['seconds']:.1f}s "
+            f"({_get_rate(produce)}/s), published {publish['items']} in "
+            f"{publish['seconds']:.1f}s of worker time ({_get_rate(publish)}/s) "
+            f"with {publish['retries']} retries and {publish['failures']} failures, "
+            f"{elapsed:.1f}s elapsed"
+        )
+
+    def _add_stat(self, stage: str, key: str, value: Any) -> None:
+        with self._lock:
+            self.stats[stage][key] += value
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            name, steps = item
+            start = monotonic()
+            try:
+                self._publish(name, steps)
+            finally:
+                self._add_stat("publish", "seconds", monotonic() - start)
+
+    def _publish(self, name: str, steps: List[Callable]) -> None:
+        for step in steps:
+            if not self._run_step(name, step):
+                return
+        self._add_stat("publish", "items", 1)
+
+    def _run_step(self, name: str, step: Callable) -> bool:
+        for attempt in range(self._retries + 1):
+            try:
+                step()
+                return True
+            except Exception as ex:
+                if attempt == self._retries:
+                    logger.exception(f"Publishing {name} failed")
+                    self._add_stat("publish", "failures", 1)
+                    with self._lock:
+                        self._errors.append((name, ex))
+                    return False
+                wait = self._backoff * 2**attempt
+                logger.warning(f"Publishing {name} failed, retrying in {wait}s: {ex}")
+                self._add_stat("publish", "retries", 1)
+                sleep(wait)
+
+
+def _get_rate(stats: Dict) -> str:
+    if not stats["seconds"]:
+        return "-"
+    return f"{stats['items'] / stats['seconds']:.2f}"
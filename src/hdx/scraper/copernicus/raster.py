@@ -0,0 +1,266 @@
+import logging
+from contextlib import ExitStack, contextmanager
+from hashlib import sha256
+from shutil import copyfileobj
+from typing import Dict, Iterator, List, Tuple
+from zipfile import ZIP64_LIMIT, ZipFile
+
+import rasterio
+from numpy import dtype, full, ndarray
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.io import DatasetReader, DatasetWriter, MemoryFile
+from rasterio.mask import raster_geometry_mask
+from rasterio.merge import merge
+from rasterio.shutil import copy, delete
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from shapely import clip_by_rect
+from shapely.geometry import mapping, shape
+
+logger = logging.getLogger(__name__)
+
+_COG_PREDICTORS = {1: "NO", 2: "STANDARD", 3: "FLOATING_POINT"}
+_HASH_STRIP_SIZE = 16 * 1024 * 1024
+
+
+def get_mask(dataset: DatasetReader, geometry: List[Dict]) -> Tuple[Window, ndarray]:
+    # Window covering the geometry and the pixels in it outside the geometry,
+    # as used by rasterio.mask.mask. Raises ValueError if the geometry does not
+    # overlap the dataset.
+    shape_mask, _, window = raster_geometry_mask(
+        dataset, geometry, all_touched=True, crop=True
+    )
+    return window, shape_mask
+
+
+def simplify_geometry(
+    geometry: List[Dict], pixel_size: float, tolerance: float
+) -> List[Dict]:
+    # Detail much finer than a pixel only slows down rasterizing. Shapes are
+    # simplified by half the tolerance, keeping their topology, then grown by
+    # the other half with mitred corners so that they still cover every pixel
+    # the original touches. The tolerance is a fraction of the pixel size and
+    # 0 leaves the geometry unchanged.
+    if not tolerance:
+        return geometry
+    distance = pixel_size * tolerance / 2
+    return [
+        mapping(
+            shape(g)
+            .simplify(distance, preserve_topology=True)
+            .buffer(distance, join_style="mitre")
+        )
+        for g in geometry
+    ]
+
+
+def clip_raster(
+    dataset: DatasetReader, window: Window, shape_mask: ndarray
+) -> Tuple[ndarray, Dict]:
+    # Only the window covering the geometry is read from the dataset
+    nodata = dataset.nodata
+    if nodata is None:
+        nodata = 0
+    mask_raster = dataset.read(window=window)
+    mask_raster[:, shape_mask] = nodata
+    mask_transform = dataset.window_transform(window)
+    mask_meta = dataset.meta.copy()
+    mask_meta.update(
+        {
+            "height": mask_raster.shape[1],
+            "width": mask_raster.shape[2],
+            "transform": mask_transform,
+        }
+    )
+    return mask_raster, mask_meta
+
+
+def clip_mosaic(
+    file_paths: List[str],
+    geometry: List[Dict],
+    output_path: str,
+    output_profile: Dict,
+) -> None:
+    # The country raster is built and written block by block from the open
+    # tile datasets so memory use does not depend on the size of the country
+    with ExitStack() as stack:
+        datasets = [stack.enter_context(rasterio.open(f)) for f in file_paths]
+        left, bottom, right, top = _get_crop_bounds(datasets, geometry)
+        xres, yres = datasets[0].res
+        mosaic_meta = datasets[0].meta.copy()
+        mosaic_meta.update(
+            {
+                "height": int(round((top - bottom) / yres)),
+                "width": int(round((right - left) / xres)),
+                "transform": from_origin(left, top, xres, yres),
+            }
+        )
+        nodata = mosaic_meta["nodata"]
+        if nodata is None:
+            nodata = 0
+        shapes = [shape(g) for g in geometry]
+        dest = stack.enter_context(
+            open_output(output_path, mosaic_meta, output_profile)
+        )
+        block_size = output_profile["blocksize"]
+        for row_off in range(0, dest.height, block_size):
+            strip = Window(
+                0, row_off, dest.width, min(block_size, dest.height - row_off)
+            )
+            # Clipping to a slightly padded strip keeps rasterizing each block
+            # cheap without changing which pixels the geometry touches
+            strip_left, strip_bottom, strip_right, strip_top = dest.window_bounds(strip)
+            strip_shapes = [
+                clip_by_rect(
+                    s,
+                    strip_left - 2 * xres,
+                    strip_bottom - 2 * yres,
+                    strip_right + 2 * xres,
+                    strip_top + 2 * yres,
+                )
+                for s in shapes
+            ]
+            strip_shapes = [s for s in strip_shapes if not s.is_empty]
+            for col_off in range(0, dest.width, block_size):
+                window = Window(
+                    col_off,
+                    row_off,
+                    min(block_size, dest.width - col_off),
+                    strip.height,
+                )
+                if not strip_shapes:
+                    block_raster = full(
+                        (dest.count, window.height, window.width),
+                        nodata,
+                        dtype=dest.dtypes[0],
+                    )
+                    dest.write(block_raster, window=window)
+                    continue
+                block_raster, block_transform = merge(
+                    datasets, bounds=dest.window_bounds(window), res=(xres, yres)
+                )
+                outside = geometry_mask(
+                    strip_shapes,
+                    out_shape=block_raster.shape[1:],
+                    transform=block_transform,
+                    all_touched=True,
+                )
+                block_raster[:, outside] = nodata
+                dest.write(block_raster, window=window)
+
+
+def check_output_profile(output_profile: Dict) -> None:
+    # GDAL only writes tiled rasters with blocks a multiple of 16 pixels, so
+    # a bad block size is caught before any country is processed
+    block_size = output_profile["blocksize"]
+    if block_size <= 0 or block_size % 16:
+        raise ValueError(
+            f"Output profile blocksize {block_size} must be a multiple of 16"
+        )
+
+
+@contextmanager
+def open_output(
+    output_path: str, meta: Dict, output_profile: Dict
+) -> Iterator[DatasetWriter]:
+    # A COG can only be created by copying a finished raster so it is written
+    # to an intermediate GeoTIFF first
+    if output_profile["driver"] == "COG":
+        gtiff_path = f"{output_path[:-4]}_gtiff.tif"
+        gtiff_profile = dict(output_profile, driver="GTiff", overviews=False)
+        with open_output(gtiff_path, meta, gtiff_profile) as dest:
+            yield dest
+        copy(
+            gtiff_path,
+            output_path,
+            driver="COG",
+            compress=output_profile["compress"],
+            predictor=_COG_PREDICTORS[output_profile["predictor"]],
+            blocksize=output_profile["blocksize"],
+            overviews="AUTO" if output_profile["overviews"] else "NONE",
+            resampling="NEAREST",
+        )
+        delete(gtiff_path)
+        return
+    block_size = output_profile["blocksize"]
+    options = {
+        "driver": "GTiff",
+        "compress": output_profile["compress"],
+        "predictor": output_profile["predictor"],
+    }
+    if max(meta["width"], meta["height"]) > block_size:
+        options.update(
+            {"tiled": True, "blockxsize": block_size, "blockysize": block_size}
+        )
+    with rasterio.open(output_path, "w", **dict(meta, **options)) as dest:
+        yield dest
+        if output_profile["overviews"]:
+            factors = []
+            factor = 2
+            while max(dest.width, dest.height) / factor >= block_size:
+                factors.append(factor)
+                factor *= 2
+            if factors:
+                dest.build_overviews(factors, Resampling.nearest)
+
+
+def write_to_zip(
+    z: ZipFile, file_name: str, raster: ndarray, meta: Dict, output_profile: Dict
+) -> None:
+    # The raster is written in memory and streamed into the zip entry
+    with MemoryFile(ext=".tif") as memfile:
+        with open_output(memfile.name, meta, output_profile) as dest:
+            dest.write(raster)
+        with z.open(file_name, "w", force_zip64=len(memfile) > ZIP64_LIMIT) as entry:
+            copyfileobj(memfile, entry)
+
+
+def get_zip_path(zip_file_path: str, member: str) -> str:
+    # Path for GDAL to read a file directly from inside a zip
+    return f"/vsizip/{zip_file_path}/{member}"
+
+
+def get_content_hash(file_path: str) -> str:
+    # Made from the pixels and georeferencing only, so it does not change with
+    # compression, tiling or other details of how the raster was written.
+    # Pixels are hashed in row order a strip at a time.
+    content_hash = sha256()
+    with rasterio.open(file_path) as dataset:
+        crs = dataset.crs.to_wkt() if dataset.crs else None
+        header = (
+            dataset.count,
+            dataset.dtypes,
+            dataset.width,
+            dataset.height,
+            crs,
+            tuple(dataset.transform),
+            dataset.nodatavals,
+        )
+        content_hash.update(repr(header).encode())
+        row_size = dataset.width * dataset.count * dtype(dataset.dtypes[0]).itemsize
+        rows = max(_HASH_STRIP_SIZE // row_size, 1)
+        for row_off in range(0, dataset.height, rows):
+            window = Window(
+                0, row_off, dataset.width, min(rows, dataset.height - row_off)
+            )
+            content_hash.update(dataset.read(window=window).tobytes())
+    return content_hash.hexdigest()
+
+
+def _get_crop_bounds(
+    datasets: List[DatasetReader], geometry: List[Dict]
+) -> Tuple[float, float, float, float]:
+    # Union of the pixel aligned windows that mask with crop=True would read
+    all_bounds = []
+    for dataset in datasets:
+        try:
+            window = geometry_window(dataset, geometry)
+        except WindowError:
+            continue
+        all_bounds.append(dataset.window_bounds(window))
+    if not all_bounds:
+        raise ValueError("Input shapes do not overlap raster.")
+    left, bottom, right, top = zip(*all_bounds)
+    return min(left), min(bottom), max(right), max(top)
@@ -0,0 +1,121 @@
+import logging
+from contextlib import contextmanager, nullcontext
+from json import dump
+from os.path import getsize
+from threading import Lock
+from time import perf_counter
+from typing import ContextManager, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+_FIELDS = ("seconds", "bytes_in", "bytes_out", "files")
+
+
+class RunReport:
+    # Time taken, bytes read and written and files made by each stage of a
+    # run, in total and for each country
+    def __init__(self):
+        self._lock = Lock()
+        self.stages = {}
+        self.countries = {}
+
+    def __getstate__(self) -> Dict:
+        # Worker processes start with an empty report so that records popped
+        # and merged back after each item are not counted twice
+        return {}
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__init__()
+
+    @contextmanager
+    def stage(self, name: str, iso3: Optional[str] = None) -> Iterator["StageRecord"]:
+        record = StageRecord()
+        start = perf_counter()
+        try:
+            yield record
+        finally:
+            record.values["seconds"] = perf_counter() - start
+            with self._lock:
+                _add(self.stages, name, record.values)
+                if iso3:
+                    _add(self.countries.setdefault(iso3, {}), name, record.values)
+
+    def pop(self) -> Dict:
+        with self._lock:
+            records = {"stages": self.stages, "countries": self.countries}
+            self.stages = {}
+            self.countries = {}
+        return records
+
+    def merge(self, records: Dict) -> None:
+        with self._lock:
+            for name, totals in records["stages"].items():
+                _add(self.stages, name, totals)
+            for iso3, stages in records["countries"].items():
+                for name, totals in stages.items():
+                    _add(self.countries.setdefault(iso3, {}), name, totals)
+
+    def save(self, file_path: str) -> None:
+        with open(file_path, "w") as f:
+            dump(
+                {"stages": self.stages, "countries": self.countries},
+                f,
+                indent=1,
+                sort_keys=True,
+            )
+
+    def log_summary(self) -> None:
+        logger.info(
+            f"{'Stage':<12}{'Count':>8}{'Seconds':>10}{'MB in':>10}{'MB out':>10}"
+            f"{'Files':>8}"
+        )
+        for name, totals in sorted(
+            self.stages.items(), key=lambda item: -item[1]["seconds"]
+        ):
+            logger.info(
+                f"{name:<12}{totals['count']:>8}{totals['seconds']:>10.1f}"
+                f"{totals['bytes_in'] / 1024**2:>10.1f}"
+                f"{totals['bytes_out'] / 1024**2:>10.1f}{totals['files']:>8}"
+            )
+
+
+class StageRecord:
+    def __init__(self):
+        self.values = {"seconds": 0.0, "bytes_in": 0, "bytes_out": 0, "files": 0}
+
+    def add(self, bytes_in: int = 0, bytes_out: int = 0, files: int = 0) -> None:
+        self.values["bytes_in"] += bytes_in
+        self.values["bytes_out"] += bytes_out
+        self.values["files"] += files
+
+    def add_file(self, file_path: str, written: bool = True) -> None:
+        key = "bytes_out" if written else "bytes_in"
+        self.values[key] += getsize(file_path)
+        self.values["files"] += 1
+
+
+class _NullRecord(StageRecord):
+    def add(self, bytes_in: int = 0, bytes_out: int = 0, files: int = 0) -> None:
+        pass
+
+    def add_file(self, file_path: str, written: bool = True) -> None:
+        pass
+
+
+_NULL_STAGE = nullcontext(_NullRecord())
+
+
+def stage(
+    report: Optional[RunReport], name: str, iso3: Optional[str] = None
+) -> ContextManager[StageRecord]:
+    # Nothing is timed or measured without a report
+    if report is None:
+        return _NULL_STAGE
+    return report.stage(name, iso3)
+
+
+def _add(stages: Dict, name: str, record: Dict) -> None:
+    totals = stages.setdefault(name, dict.fromkeys(("count",) + _FIELDS, 0))
+    totals["count"] += record.get("count", 1)
+    for field in _FIELDS:
+        totals[field] += record[field]
@@ -1,33 +1,188 @@
 import logging
-from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-from bs4 import BeautifulSoup
 from geopandas import GeoDataFrame, read_file
 from hdx.api.configuration import Configuration
 from hdx.data.dataset import Dataset
+from hdx.utilities.base_downloader import DownloadError
+from hdx.utilities.downloader import Download
 from hdx.utilities.retriever import Retrieve
-from pandas import isna
-from shapely.validation import make_valid
+from requests import RequestException, Response
+
+from hdx.scraper.copernicus.cache import GeometryCache, ValidatorCache
+from hdx.scraper.copernicus.report import RunReport, stage
 
 logger = logging.getLogger(__name__)
 
 
 def get_lines(
-    retriever: Retrieve, url: str, filename: Optional[str] = None
+    retriever: Retrieve,
+    url: str,
+    filename: Optional[str] = None,
+    listing_cache: Optional[ValidatorCache] = None,
+    report: Optional[RunReport] = None,
+    timeout: Optional[float] = None,
 ) -> List[str]:
-    text = retriever.download_text(url, filename=filename)
-    soup = BeautifulSoup(text, "html.parser")
-    lines = soup.find_all("a")
-    return lines
+    with stage(report, "list") as record:
+        if listing_cache is None or retriever.save or retriever.use_saved:
+            text = retriever.download_text(url, filename=filename)
+            record.add(bytes_in=len(text), files=1)
+            return _get_hrefs(text)
+        # The listing is only downloaded and parsed again if it has changed
+        listing = listing_cache.get(url)
+        try:
+            with _revalidate(
+                retriever.downloader.session.get, url, listing, timeout=timeout
+            ) as response:
+                if response is None:
+                    return listing["hrefs"]
+                response.raise_for_status()
+                record.add(bytes_in=len(response.content), files=1)
+                hrefs = _get_hrefs(response.text)
+                validators = _get_validators(response)
+        except RequestException as ex:
+            # As with Retrieve, the last copy of the listing is used if the
+            # download fails
+            if not listing:
+                raise DownloadError(f"Download of {url} failed: {ex}") from ex
+            logger.warning(f"Using cached listing of {url}: {ex}")
+            return listing["hrefs"]
+        listing_cache.set(url, **validators, hrefs=hrefs)
+        return hrefs
+
+
+@contextmanager
+def _revalidate(
+    request: Callable, url: str, cached: Optional[Dict], **kwargs: Any
+) -> Iterator[Optional[Response]]:
+    # Requests the URL with the validators of any cached copy, giving None if
+    # that copy is still current
+    headers = {}
+    if cached:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+    with request(url, headers=headers, **kwargs) as response:
+        if cached and response.status_code == 304:
+            yield None
+        else:
+            yield response
+
+
+def _get_validators(response: Response) -> Dict:
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+class _HrefParser(HTMLParser):
+    # Only the links are needed from a listing so no document tree is built
+    def __init__(self):
+        super().__init__()
+        self.hrefs = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, str]]) -> None:
+        if tag != "a":
+            return
+        href = dict(attrs).get("href")
+        if href:
+            self.hrefs.append(href)
+
+
+def _get_hrefs(text: str) -> List[str]:
+    parser = _HrefParser()
+    parser.feed(text)
+    parser.close()
+    return parser.hrefs
+
+
+def download_files(
+    retriever: Retrieve,
+    urls: List[str],
+    max_workers: int,
+    process: Optional[Callable[[str, str], Any]] = None,
+    report: Optional[RunReport] = None,
+) -> List:
+    # Download objects keep the last response so each download gets its own,
+    # sharing the session (and its connection pool) of the given retriever
+    def download(url: str) -> Any:
+        downloader = Download(session=retriever.downloader.session)
+        try:
+            with stage(report, "download") as record:
+                file_path = retriever.clone(downloader).download_file(url)
+                record.add_file(file_path, written=False)
+        finally:
+            downloader.close_response()
+        if process:
+            return process(url, file_path)
+        return file_path
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(download, urls))
+
+
+def get_file_sizes(
+    retriever: Retrieve,
+    urls: List[str],
+    max_workers: int,
+    timeout: Optional[float] = None,
+    size_cache: Optional[ValidatorCache] = None,
+) -> Dict[str, int]:
+    # HEAD requests are made concurrently over the session of the given
+    # retriever and revalidated against any cached sizes
+    session = retriever.downloader.session
+
+    def get_size(url: str) -> Dict:
+        cached = size_cache.get(url) if size_cache else None
+        with _revalidate(
+            session.head, url, cached, timeout=timeout, allow_redirects=True
+        ) as response:
+            if response is None:
+                return cached
+            if not response.ok:
+                raise DownloadError(
+                    f"HEAD of {url} failed with status {response.status_code}"
+                )
+            size = response.headers.get("Content-Length")
+            if size is None:
+                raise DownloadError(f"HEAD of {url} returned no Content-Length")
+            return {**_get_validators(response), "size": int(size)}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(get_size, urls))
+    sizes = {}
+    for url, result in zip(urls, results):
+        if size_cache and size_cache.get(url) != result:
+            size_cache.set(url, **result)
+        sizes[url] = result["size"]
+    return sizes
 
 
 def get_boundaries(
-    configuration: Configuration, retriever: Retrieve, temp_folder: str
+    configuration: Configuration,
+    retriever: Retrieve,
+    temp_folder: str,
+    cache: Optional[GeometryCache] = None,
 ) -> Tuple[GeoDataFrame, GeoDataFrame]:
     dataset = Dataset.read_from_hdx(configuration["boundary_dataset"])
     resources = dataset.get_resources()
     resource = [r for r in resources if configuration["boundary_resource"] in r["name"]]
     resource = resource[0]
+    if cache:
+        key = cache.get_key(
+            resource["id"],
+            resource.get("last_modified"),
+            resource.get("hash"),
+            resource.get("size"),
+        )
+        boundaries = cache.load_boundaries(key)
+        if boundaries:
+            return boundaries
     if retriever.use_saved:
         file_path = retriever.download_file(resource["url"], filename=resource["name"])
     else:
@@ -38,15 +193,17 @@ def get_boundaries(
 
     lyr_mollweide = lyr.to_crs(crs="ESRI:54009")
     lyr_mollweide = make_valid_dissolve(lyr_mollweide)
+    if cache:
+        cache.save_boundaries(key, lyr_wgs, lyr_mollweide)
     return lyr_wgs, lyr_mollweide
 
 
 def make_valid_dissolve(lyr: GeoDataFrame) -> GeoDataFrame:
-    for i, row in lyr.iterrows():
-        if not lyr.geometry[i].is_valid:
-            lyr.loc[i, "geometry"] = make_valid(lyr.geometry[i])
-        if not isna(row["STATUS"]) and row["STATUS"][:4] == "Adm.":
-            lyr.loc[i, "ISO_3"] = row["Color_Code"]
+    invalid = ~lyr.geometry.is_valid
+    lyr.loc[invalid, "geometry"] = lyr.geometry[invalid].make_valid()
+    # Areas under administration of another country are dissolved into it
+    administered = lyr["STATUS"].astype("string").str.startswith("Adm.", na=False)
+    lyr.loc[administered, "ISO_3"] = lyr.loc[administered, "Color_Code"]
     lyr = lyr.dissolve(by="ISO_3", as_index=False)
     lyr = lyr.drop(
         [f for f in lyr.columns if f.lower() not in ["iso_3", "geometry"]],
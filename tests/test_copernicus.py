@@ -1,14 +1,251 @@
 import datetime
-from os.path import join
+from email.parser import BytesParser
+from email.policy import default
+from functools import partial
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, load, loads
+from os import remove
+from os.path import basename, join
 from pathlib import PosixPath
+from threading import Thread
+from zipfile import ZipFile
 
+import pytest
+import rasterio
+from bs4 import BeautifulSoup
+from geopandas import GeoDataFrame
+from hdx.api.configuration import Configuration
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
+from hdx.data.vocabulary import Vocabulary
+from hdx.utilities.base_downloader import DownloadError
 from hdx.utilities.downloader import Download
 from hdx.utilities.path import temp_dir
 from hdx.utilities.retriever import Retrieve
+from numpy import arange, cos, linspace, sin
+from rasterio.features import geometry_mask
+from rasterio.mask import mask
+from rasterio.transform import from_origin
+from shapely.geometry import Polygon, box, mapping, shape
 
+from hdx.scraper.copernicus.__main__ import (
+    get_drought_publish_steps,
+    get_processed_drought_files,
+)
+from hdx.scraper.copernicus.cache import (
+    GeometryCache,
+    MaskIndex,
+    ValidatorCache,
+)
 from hdx.scraper.copernicus.drought import Drought
 from hdx.scraper.copernicus.ghsl import GHSL
-from hdx.scraper.copernicus.utilities import get_boundaries
+from hdx.scraper.copernicus.journal import RunJournal
+from hdx.scraper.copernicus.manifest import Manifest
+from hdx.scraper.copernicus.parallel import process_in_pool, split_list
+from hdx.scraper.copernicus.publisher import Publisher
+from hdx.scraper.copernicus.raster import (
+    check_output_profile,
+    clip_raster,
+    get_content_hash,
+    get_zip_path,
+    simplify_geometry,
+)
+from hdx.scraper.copernicus.report import RunReport, stage
+from hdx.scraper.copernicus.utilities import (
+    get_boundaries,
+    get_file_sizes,
+    get_lines,
+    make_valid_dissolve,
+)
+
+
+class Squarer:
+    def __init__(self, offset):
+        self.offset = offset
+
+    def process(self, number, multiplier):
+        return number * number * multiplier + self.offset
+
+
+class ReportingSquarer(Squarer):
+    def __init__(self, offset):
+        super().__init__(offset)
+        self.report = RunReport()
+
+    def process(self, number, multiplier):
+        with stage(self.report, "square", str(number)) as record:
+            record.add(bytes_out=number, files=1)
+            return super().process(number, multiplier)
+
+
+class FakeHDX:
+    def __init__(self, failures):
+        self.failures = failures
+        self.datasets = {}
+        self.calls = 0
+
+    def create_in_hdx(self, dataset, batch):
+        self.calls += 1
+        if self.failures.get(dataset, 0) > 0:
+            self.failures[dataset] -= 1
+            raise ConnectionError(f"Could not create {dataset}")
+        self.datasets[dataset] = batch
+
+
+class ListingHandler(BaseHTTPRequestHandler):
+    listing = ("v1", '<a href="../">Up</a><a href="ver1-0-0/">ver1-0-0/</a>')
+    statuses = []
+
+    def do_GET(self):
+        etag, text = self.listing
+        if self.headers.get("If-None-Match") == etag:
+            self.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.statuses.append(200)
+        body = text.encode()
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SizeHandler(BaseHTTPRequestHandler):
+    sizes = {"/built.zip": ("b1", 3 * 1024**3), "/population.zip": ("p1", 1024**3)}
+    statuses = []
+
+    def do_HEAD(self):
+        if self.path not in self.sizes:
+            self.statuses.append(200)
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            return
+        etag, size = self.sizes[self.path]
+        if self.headers.get("If-None-Match") == etag:
+            self.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.statuses.append(200)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HDXHandler(BaseHTTPRequestHandler):
+    # Stand-in for the CKAN actions used to publish a dataset in HDX
+    packages = {}
+    calls = []
+    uploads = []
+    failures = {}
+
+    def do_POST(self):
+        action = self.path.split("?")[0].rsplit("/", 1)[-1]
+        self.calls.append(action)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.failures.get(action, 0) > 0:
+            self.failures[action] -= 1
+            self.send_result(409, {"message": f"{action} failed"})
+            return
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            data = self.read_form(content_type, body)
+        else:
+            data = loads(body or b"{}")
+        if action == "package_show":
+            for package in self.packages.values():
+                if data["id"] in (package["id"], package["name"]):
+                    self.send_result(200, package)
+                    return
+            self.send_result(404, {"__type": "Not Found Error"})
+        elif action == "package_create":
+            data["id"] = f"package-{len(self.packages)}"
+            self.add_resource_ids(data)
+            self.packages[data["id"]] = data
+            self.send_result(200, data)
+        elif action == "package_revise":
+            package = self.packages[loads(data["match"])["id"]]
+            for key in loads(data.get("filter", "[]")):
+                del package["resources"][int(key.split("__")[1])]
+            update = loads(data.get("update", "{}"))
+            # Resources are updated by position, as package_revise does
+            resources = package.get("resources", [])
+            for i, resource in enumerate(update.pop("resources", [])):
+                if i < len(resources):
+                    resources[i].update(resource)
+                else:
+                    resources.append(resource)
+            package.update(update, resources=resources)
+            self.add_resource_ids(package)
+            self.send_result(200, {"package": package})
+        elif action == "package_resource_reorder":
+            package = self.packages[data["id"]]
+            resources = {r["id"]: r for r in package["resources"]}
+            package["resources"] = [resources[i] for i in data["order"]]
+            self.send_result(200, {"id": data["id"], "order": data["order"]})
+        else:
+            self.send_result(200, {})
+
+    def read_form(self, content_type, body):
+        message = BytesParser(policy=default).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        data = {}
+        for part in message.iter_parts():
+            if part.get_filename():
+                self.uploads.append(part.get_filename())
+            else:
+                data[part.get_param("name", header="content-disposition")] = (
+                    part.get_content()
+                )
+        return data
+
+    def add_resource_ids(self, package):
+        for i, resource in enumerate(package.get("resources", [])):
+            resource.setdefault("id", f"{package['id']}-{resource['name']}")
+            resource["package_id"] = package["id"]
+            resource["position"] = i
+
+    def send_result(self, status, result):
+        success = status == 200
+        key = "result" if success else "error"
+        body = dumps({"success": success, key: result}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_raster(file_path, data, **options):
+    count, height, width = data.shape
+    with rasterio.open(
+        file_path,
+        "w",
+        driver="GTiff",
+        count=count,
+        height=height,
+        width=width,
+        dtype=data.dtype,
+        crs="EPSG:4326",
+        transform=from_origin(-80, 20, 0.01, 0.01),
+        **options,
+    ) as dest:
+        dest.write(data)
 
 
 class TestCopernicus:
@@ -165,19 +402,16 @@ class TestCopernicus:
                     },
                 ]
 
-                file_paths = drought.unzip_data("drought_tracking")
-                assert file_paths == {}
-
-                file_paths = drought.unzip_data("fapar")
+                file_paths = drought.list_data("fapar")
                 assert file_paths == {
-                    join(tempdir, "fpanv_m_gdo_20250101_20250601_t"): [
+                    join(input_dir, "fpanv_m_gdo_20250101_20250601_t.zip"): [
                         "fpanv_m_gdo_20250101_t_300_z01.tif",
                         "copyright.txt",
                         "README.txt",
                     ],
                 }
 
-                country_data = drought.process("CUB", file_paths)
+                country_data = drought.process("CUB", "fapar", file_paths)
                 assert country_data == [
                     join(tempdir, "cub_fpanv_m_gdo_20250101_20250601_t.zip")
                 ]
@@ -217,28 +451,47 @@ class TestCopernicus:
                 updated = ghsl.get_data(2024, True)
                 assert updated is True
                 assert ghsl.data_year == {"built": 2020, "population": 2020}
+                assert len(ghsl.tiling_schema) == 375
+                assert list(ghsl.global_boundaries) == ["CUB", "JAM"]
+                assert ghsl.tiles_by_country == {
+                    "CUB": {"R7_C10", "R7_C11"},
+                    "JAM": {"R7_C11"},
+                }
+                assert ghsl.get_required_tiles() == {"R7_C10", "R7_C11"}
                 assert ghsl.global_data == {
                     "built": "https://jeodpp.jrc.ec.europa.eu/ftp/jrc-opendata/GHSL/GHS_BUILT_S_GLOBE_R2023A/GHS_BUILT_S_E2020_GLOBE_R2023A_54009_100/V1-0/GHS_BUILT_S_E2020_GLOBE_R2023A_54009_100_V1_0.zip",
                     "population": "https://jeodpp.jrc.ec.europa.eu/ftp/jrc-opendata/GHSL/GHS_POP_GLOBE_R2023A/GHS_POP_E2020_GLOBE_R2023A_54009_100/V1-0/GHS_POP_E2020_GLOBE_R2023A_54009_100_V1_0.zip",
                 }
                 assert ghsl.latest_data == {
                     "built": [
-                        join(
-                            tempdir,
+                        get_zip_path(
+                            join(
+                                input_dir,
+                                "tiles-ghs-built-s-e2020-globe-r2023a-54009-100-v1-0-r7-c10.zip",
+                            ),
                             "GHS_BUILT_S_E2020_GLOBE_R2023A_54009_100_V1_0_R7_C10.tif",
                         ),
-                        join(
-                            tempdir,
+                        get_zip_path(
+                            join(
+                                input_dir,
+                                "tiles-ghs-built-s-e2020-globe-r2023a-54009-100-v1-0-r7-c11.zip",
+                            ),
                             "GHS_BUILT_S_E2020_GLOBE_R2023A_54009_100_V1_0_R7_C11.tif",
                         ),
                     ],
                     "population": [
-                        join(
-                            tempdir,
+                        get_zip_path(
+                            join(
+                                input_dir,
+                                "tiles-ghs-pop-e2020-globe-r2023a-54009-100-v1-0-r7-c10.zip",
+                            ),
                             "GHS_POP_E2020_GLOBE_R2023A_54009_100_V1_0_R7_C10.tif",
                         ),
-                        join(
-                            tempdir,
+                        get_zip_path(
+                            join(
+                                input_dir,
+                                "tiles-ghs-pop-e2020-globe-r2023a-54009-100-v1-0-r7-c11.zip",
+                            ),
                             "GHS_POP_E2020_GLOBE_R2023A_54009_100_V1_0_R7_C11.tif",
                         ),
                     ],
@@ -276,15 +529,6 @@ class TestCopernicus:
                     ],
                 }
 
-                ghsl.get_tiling_schema()
-                assert len(ghsl.tiling_schema) == 375
-                iso3s = ghsl.get_boundaries()
-                assert iso3s == ["CUB", "JAM"]
-                assert ghsl.tiles_by_country == {
-                    "CUB": ["R7_C10", "R7_C11"],
-                    "JAM": ["R7_C11"],
-                }
-
                 country_data = ghsl.process("CUB")
                 assert country_data == {
                     "built": join(
@@ -345,3 +589,726 @@ class TestCopernicus:
                         "format": "geotiff",
                     },
                 ]
+
+    def test_process_in_pool(self):
+        assert split_list(["A", "B", "C", "D", "E"], 2) == [
+            ["A", "B", "C"],
+            ["D", "E"],
+        ]
+        assert split_list(["A"], 4) == [["A"]]
+        for processes in (1, 2):
+            results = process_in_pool(Squarer(1), "process", [1, 2, 3], processes, 10)
+            assert list(results) == [(1, 11), (2, 41), (3, 91)]
+
+    def test_run_report(self):
+        for processes in (1, 2):
+            squarer = ReportingSquarer(1)
+            # Stages recorded before the pool starts are only counted once
+            with stage(squarer.report, "boundaries") as record:
+                record.add(files=1)
+            results = process_in_pool(squarer, "process", [1, 2, 3], processes, 10)
+            assert list(results) == [(1, 11), (2, 41), (3, 91)]
+            assert squarer.report.stages["boundaries"]["count"] == 1
+            assert squarer.report.stages["boundaries"]["files"] == 1
+            totals = squarer.report.stages["square"]
+            assert totals["count"] == 3
+            assert totals["bytes_out"] == 6
+            assert totals["files"] == 3
+            assert squarer.report.countries["2"]["square"]["bytes_out"] == 2
+
+        with stage(None, "square") as record:
+            record.add(files=1)
+        records = squarer.report.pop()
+        assert squarer.report.stages == {}
+        assert records["stages"]["square"]["count"] == 3
+        report = RunReport()
+        report.merge(records)
+        report.merge(records)
+        assert report.stages["square"]["count"] == 6
+        with temp_dir("TestRunReport") as tempdir:
+            report_path = join(tempdir, "report.json")
+            report.save(report_path)
+            with open(report_path) as f:
+                saved = load(f)
+        assert saved["stages"]["square"]["files"] == 6
+        assert sorted(saved["countries"]) == ["1", "2", "3"]
+
+    def test_geometry_cache(self, configuration, read_dataset, input_dir):
+        with temp_dir(
+            "TestGeometryCache",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            with Download(user_agent="test") as downloader:
+                retriever = Retrieve(
+                    downloader=downloader,
+                    fallback_dir=tempdir,
+                    saved_dir=input_dir,
+                    temp_dir=tempdir,
+                    save=False,
+                    use_saved=True,
+                )
+                cache = GeometryCache(join(tempdir, "state"))
+                boundaries = get_boundaries(configuration, retriever, tempdir, cache)
+                cached_boundaries = get_boundaries(
+                    configuration, retriever, tempdir, cache
+                )
+                for lyr, cached_lyr in zip(boundaries, cached_boundaries):
+                    assert list(cached_lyr["ISO_3"]) == list(lyr["ISO_3"])
+                    assert cached_lyr.geom_equals_exact(lyr, 0).all()
+                assert cache.load_tiles("test") is None
+                cache.save_tiles("test", {"CUB": {"R7_C10", "R7_C11"}})
+                assert cache.load_tiles("test") == {"CUB": {"R7_C10", "R7_C11"}}
+
+    def test_make_valid_dissolve(self):
+        lyr = GeoDataFrame(
+            {
+                "ISO_3": ["AAA", "BBB", "CCC"],
+                "STATUS": ["Member State", None, "Adm. by AAA"],
+                "Color_Code": ["AAA", "BBB", "AAA"],
+                "geometry": [
+                    Polygon([(0, 0), (1, 1), (1, 0), (0, 1)]),
+                    Polygon([(2, 0), (3, 0), (3, 1), (2, 1)]),
+                    Polygon([(4, 0), (5, 0), (5, 1), (4, 1)]),
+                ],
+            },
+            crs="EPSG:4326",
+        )
+        lyr = make_valid_dissolve(lyr)
+        assert list(lyr.columns) == ["ISO_3", "geometry"]
+        assert list(lyr["ISO_3"]) == ["AAA", "BBB"]
+        assert lyr.is_valid.all()
+        assert lyr.geometry[0].area == 1.5
+
+    def test_publisher(self):
+        hdx = FakeHDX({"cub-ghsl": 2})
+        with Publisher(workers=2, queue_size=1, retries=2, backoff=0) as publisher:
+            for iso3 in ("cub", "jam", "hti"):
+                publisher.submit_steps(
+                    iso3, [partial(hdx.create_in_hdx, f"{iso3}-ghsl", batch="1234")]
+                )
+        assert hdx.datasets == {
+            "cub-ghsl": "1234",
+            "jam-ghsl": "1234",
+            "hti-ghsl": "1234",
+        }
+        assert hdx.calls == 5
+        assert publisher.stats["produce"]["items"] == 3
+        assert publisher.stats["publish"]["items"] == 3
+        assert publisher.stats["publish"]["retries"] == 2
+
+        hdx = FakeHDX({"cub-ghsl": 3})
+        with pytest.raises(RuntimeError, match="first was cub"):
+            with Publisher(workers=2, retries=2, backoff=0) as publisher:
+                for iso3 in ("cub", "jam"):
+                    publisher.submit_steps(
+                        iso3,
+                        [partial(hdx.create_in_hdx, f"{iso3}-ghsl", batch="1234")],
+                    )
+        assert hdx.datasets == {"jam-ghsl": "1234"}
+        assert publisher.stats["publish"]["failures"] == 1
+
+    def test_publish_to_hdx(self, configuration, config_dir, monkeypatch):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), HDXHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        # The global configuration is restored after the test
+        monkeypatch.setattr(Configuration, "_configuration", Configuration.read())
+        monkeypatch.setattr(Resource, "_formats_dict", {"geotiff": "geotiff"})
+        monkeypatch.setattr(
+            Vocabulary,
+            "_tags_dict",
+            {tag: {"Action to Take": "ok"} for tag in ("drought", "environment")},
+        )
+        Configuration._create(
+            hdx_url=f"http://127.0.0.1:{server.server_port}",
+            hdx_key="12345678-1234-4234-8234-123456789012",
+            hdx_read_only=False,
+            user_agent="test",
+        )
+        HDXHandler.packages = {
+            "package-0": {
+                "id": "package-0",
+                "name": "cub-anomalies-fapar-viirs",
+                "resources": [
+                    {
+                        "id": resource_id,
+                        "name": f"cub_{name}.zip",
+                        "description": name,
+                        "format": "geotiff",
+                        "url": f"http://test/cub_{name}.zip",
+                        "url_type": "upload",
+                        "resource_type": "file.upload",
+                    }
+                    for resource_id, name in (
+                        ("1", "a"),
+                        ("2", "b_20250101_20250601_t"),
+                    )
+                ],
+            }
+        }
+        HDXHandler.calls = []
+        HDXHandler.uploads = []
+        # Only reordering fails so the files must not be uploaded again
+        HDXHandler.failures = {"package_resource_reorder": 1}
+        try:
+            with (
+                temp_dir("TestPublishToHDX") as tempdir,
+                Download(user_agent="test") as downloader,
+            ):
+                retriever = Retrieve(downloader, tempdir, tempdir, tempdir)
+                boundaries = GeoDataFrame({"ISO_3": []}, geometry=[], crs="EPSG:4326")
+                manifest = Manifest(join(tempdir, "drought_manifest.json"))
+                journal = RunJournal(join(tempdir, "journal.json"))
+                drought = Drought(
+                    configuration["drought"], retriever, boundaries, manifest
+                )
+                drought.dates["fapar"] = [
+                    datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+                ]
+                drought.global_data["fapar"] = [
+                    "https://test/b_20250101_20250601_t.zip",
+                    "https://test/c_20250101_20250601_t.zip",
+                ]
+                country_zips = []
+                for name in ("b", "c"):
+                    tif_path = join(tempdir, f"{name}_20250101_t.tif")
+                    write_raster(tif_path, arange(16, dtype="uint8").reshape(1, 4, 4))
+                    country_zip = join(tempdir, f"cub_{name}_20250101_20250601_t.zip")
+                    with ZipFile(country_zip, "w") as z:
+                        z.write(tif_path, basename(tif_path))
+                    country_zips.append(country_zip)
+                drought.country_data["fapar"] = {"CUB": country_zips}
+                dataset = drought.generate_dataset("CUB", "fapar")
+                dataset.update_from_yaml(join(config_dir, "hdx_dataset_static.yaml"))
+                dataset["tags"] = [{"name": "drought"}]
+                steps = get_drought_publish_steps(
+                    drought,
+                    journal,
+                    None,
+                    "6ba7b810-9dad-41d1-80b4-00c04fd430c8",
+                    dataset,
+                    "CUB",
+                    "fapar",
+                )
+                with Publisher(workers=1, retries=2, backoff=0) as publisher:
+                    publisher.submit_steps(dataset["name"], steps)
+                assert publisher.stats["publish"]["items"] == 1
+                assert publisher.stats["publish"]["retries"] == 1
+                assert sorted(HDXHandler.uploads) == [
+                    "cub_b_20250101_20250601_t.zip",
+                    "cub_c_20250101_20250601_t.zip",
+                ]
+                package = HDXHandler.packages["package-0"]
+                assert [r["name"] for r in package["resources"]] == [
+                    "cub_c_20250101_20250601_t.zip",
+                    "cub_b_20250101_20250601_t.zip",
+                ]
+                assert journal.get("publish", "cub-anomalies-fapar-viirs")
+                assert manifest.get_checksum(
+                    "fapar", "CUB", "cub_c_20250101_20250601_t.zip"
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+        # Only the clean up is retried after reordering fails
+        assert HDXHandler.calls.count("package_revise") == 2
+        assert HDXHandler.calls.count("package_resource_reorder") == 2
+
+    def test_clean_up_resources(self, configuration, monkeypatch):
+        calls = []
+        # Resources as stored in HDX
+        server = []
+
+        def revise(match, filter):
+            calls.append(("revise", match, filter))
+            for index in filter:
+                del server[int(index.split("__")[1])]
+            dataset = Dataset({"id": "1234"})
+            dataset.add_update_resources(
+                [
+                    {"id": i, "name": f"cub_{name}.zip", "format": "geotiff"}
+                    for i, name in server
+                ]
+            )
+            return dataset
+
+        def reorder_resources(dataset, resource_ids):
+            calls.append(("reorder", resource_ids))
+
+        monkeypatch.setattr(Dataset, "revise", staticmethod(revise))
+        monkeypatch.setattr(Dataset, "reorder_resources", reorder_resources)
+        with (
+            temp_dir("TestCleanUp") as tempdir,
+            Download(user_agent="test") as downloader,
+        ):
+            retriever = Retrieve(downloader, tempdir, tempdir, tempdir)
+            boundaries = GeoDataFrame({"ISO_3": []}, geometry=[], crs="EPSG:4326")
+            drought = Drought(configuration["drought"], retriever, boundaries)
+            drought.global_data["fapar"] = [
+                "https://test/b.zip",
+                "https://test/c.zip",
+            ]
+            server[:] = [("1", "a"), ("2", "b"), ("3", "c")]
+            dataset = Dataset({"id": "1234"})
+            dataset.add_update_resources(
+                [
+                    {
+                        "id": "1",
+                        "name": "cub_a.zip",
+                        "description": "a",
+                        "format": "geotiff",
+                    },
+                    {
+                        "id": "2",
+                        "name": "cub_b.zip",
+                        "description": "b",
+                        "format": "geotiff",
+                    },
+                    {"id": "3", "name": "cub_c.zip", "format": "geotiff"},
+                ]
+            )
+            drought.clean_up_resources("CUB", dataset, "fapar")
+            assert calls == [
+                ("revise", {"id": "1234"}, ["-resources__0"]),
+                ("reorder", ["3", "2"]),
+            ]
+            assert server == [("2", "b"), ("3", "c")]
+            # A retry after reordering fails does not delete anything again
+            assert [r["id"] for r in dataset.get_resources()] == ["2", "3"]
+            calls.clear()
+            drought.clean_up_resources("CUB", dataset, "fapar")
+            assert calls == [("reorder", ["3", "2"])]
+
+            calls.clear()
+            dataset = Dataset({"id": "1234"})
+            dataset.add_update_resources(
+                [
+                    {"id": "3", "name": "cub_c.zip", "format": "geotiff"},
+                    {
+                        "id": "2",
+                        "name": "cub_b.zip",
+                        "description": "b",
+                        "format": "geotiff",
+                    },
+                ]
+            )
+            drought.clean_up_resources("CUB", dataset, "fapar")
+            assert calls == []
+
+    def test_drought_not_updated(self, configuration, input_dir, monkeypatch):
+        dataset_files = {
+            "global-meteorological-drought-tracking": [
+                "jspa3_m_wld_20240101_20241221_t.zip",
+                "jspa3_m_wld_20250101_20250611_t.zip",
+            ],
+            "global-anomalies-fapar-viirs": [
+                "fpanv_m_gdo_20240101_20241221_t.zip",
+                "fpanv_m_gdo_20250101_20250601_t.zip",
+            ],
+        }
+        monkeypatch.setattr(
+            "hdx.scraper.copernicus.drought._get_dataset_files",
+            lambda name: list(dataset_files[name]),
+        )
+        with (
+            temp_dir("TestDroughtNotUpdated") as tempdir,
+            Download(user_agent="test") as downloader,
+        ):
+            retriever = Retrieve(
+                downloader, tempdir, input_dir, tempdir, save=False, use_saved=True
+            )
+            boundaries = GeoDataFrame({"ISO_3": []}, geometry=[], crs="EPSG:4326")
+            manifest = Manifest(join(tempdir, "drought_manifest.json"))
+            drought = Drought(configuration["drought"], retriever, boundaries, manifest)
+            # The GeoJSON files are downloaded but have all been published
+            assert drought.get_data(True) is False
+            assert len(drought.downloaded_data["drought_tracking"]) == 2
+            assert "fapar" not in drought.downloaded_data
+
+            dataset_files["global-meteorological-drought-tracking"].pop()
+            drought = Drought(configuration["drought"], retriever, boundaries, manifest)
+            assert drought.get_data(True) is True
+
+    def test_drought_tracking(self, configuration):
+        def feature(cluster_id, geometry):
+            return {
+                "type": "Feature",
+                "properties": {"id": cluster_id},
+                "geometry": mapping(geometry),
+            }
+
+        def write_tracking(zip_path, dekads):
+            with ZipFile(zip_path, "w") as z:
+                for file_name, features in dekads.items():
+                    collection = {"type": "FeatureCollection", "features": features}
+                    z.writestr(file_name, dumps(collection))
+                z.writestr("copyright.txt", "copyright")
+
+        with (
+            temp_dir("TestDroughtTracking") as tempdir,
+            Download(user_agent="test") as downloader,
+        ):
+            retriever = Retrieve(downloader, tempdir, tempdir, tempdir)
+            boundaries = GeoDataFrame(
+                {"ISO_3": ["CUB", "JAM"]},
+                geometry=[box(-80, 20, -76, 23), box(-76, 20, -74, 23)],
+                crs="EPSG:4326",
+            )
+            zip_2024 = join(tempdir, "jspa3_m_wld_20240101_20241221_t.zip")
+            write_tracking(
+                zip_2024,
+                {
+                    "jspa3_m_wld_20241221_t.json": [
+                        feature(1, box(-79, 21, -78, 22)),
+                        feature(2, box(-70, 21, -69, 22)),
+                        # Only touches Jamaica along its border
+                        feature(3, box(-74, 21, -73, 22)),
+                    ]
+                },
+            )
+            zip_2025 = join(tempdir, "jspa3_m_wld_20250101_20250611_t.zip")
+            write_tracking(
+                zip_2025,
+                {
+                    "jspa3_m_wld_20250101_t.json": [
+                        feature(4, box(-77, 21, -75, 22)),
+                        feature(5, box(-79, 21, -78, 22)),
+                    ],
+                    "jspa3_m_wld_20250111_t.json": [
+                        feature(6, box(-75, 20.5, -74.5, 21)),
+                    ],
+                },
+            )
+            drought = Drought(configuration["drought"], retriever, boundaries)
+            drought.downloaded_data["drought_tracking"] = [zip_2024, zip_2025]
+            drought.dates["drought_tracking"] = [
+                datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc),
+                datetime.datetime(2025, 6, 11, tzinfo=datetime.timezone.utc),
+            ]
+            file_paths = drought.list_data("drought_tracking")
+            country_data = drought.process_countries(
+                ["CUB", "JAM"], "drought_tracking", file_paths
+            )
+            cub_2024 = join(tempdir, "cub_jspa3_m_wld_20240101_20241221_t.zip")
+            cub_2025 = join(tempdir, "cub_jspa3_m_wld_20250101_20250611_t.zip")
+            jam_2025 = join(tempdir, "jam_jspa3_m_wld_20250101_20250611_t.zip")
+            assert country_data == {"CUB": [cub_2024, cub_2025], "JAM": [jam_2025]}
+
+            def read_clusters(zip_path):
+                with ZipFile(zip_path, "r") as z:
+                    return {
+                        file_name: [
+                            (f["properties"]["id"], shape(f["geometry"]).bounds)
+                            for f in loads(z.read(file_name))["features"]
+                        ]
+                        for file_name in z.namelist()
+                        if file_name.endswith(".json")
+                    }
+
+            assert read_clusters(cub_2024) == {
+                "jspa3_m_wld_20241221_t.json": [(1, (-79.0, 21.0, -78.0, 22.0))]
+            }
+            assert read_clusters(cub_2025) == {
+                "jspa3_m_wld_20250101_t.json": [
+                    (4, (-77.0, 21.0, -76.0, 22.0)),
+                    (5, (-79.0, 21.0, -78.0, 22.0)),
+                ]
+            }
+            assert read_clusters(jam_2025) == {
+                "jspa3_m_wld_20250101_t.json": [(4, (-76.0, 21.0, -75.0, 22.0))],
+                "jspa3_m_wld_20250111_t.json": [(6, (-75.0, 20.5, -74.5, 21.0))],
+            }
+            with ZipFile(jam_2025, "r") as z:
+                assert z.read("copyright.txt") == b"copyright"
+
+            dataset = drought.generate_dataset("CUB", "drought_tracking")
+            assert dataset["name"] == "cub-meteorological-drought-tracking"
+            assert dataset.get_resources() == [
+                {
+                    "name": "cub_jspa3_m_wld_20250101_20250611_t.zip",
+                    "description": "Data from 2025-01-01 to 2025-06-20",
+                    "format": "geojson",
+                },
+                {
+                    "name": "cub_jspa3_m_wld_20240101_20241221_t.zip",
+                    "description": "Data from 2024-01-01 to 2024-12-31",
+                    "format": "geojson",
+                },
+            ]
+
+    def test_manifest(self, configuration):
+        with (
+            temp_dir("TestManifest") as tempdir,
+            Download(user_agent="test") as downloader,
+        ):
+            retriever = Retrieve(downloader, tempdir, tempdir, tempdir)
+            boundaries = GeoDataFrame({"ISO_3": []}, geometry=[], crs="EPSG:4326")
+            manifest_path = join(tempdir, "state", "drought_manifest.json")
+            country_zip = join(tempdir, "cub_fpanv_m_gdo_20250101_20250601_t.zip")
+            tif_path = join(tempdir, "fpanv_m_gdo_20250101_t_300_z01.tif")
+            write_raster(tif_path, arange(16, dtype="uint8").reshape(1, 4, 4))
+            with ZipFile(country_zip, "w") as z:
+                z.write(tif_path, basename(tif_path))
+
+            def get_drought():
+                drought = Drought(
+                    configuration["drought"],
+                    retriever,
+                    boundaries,
+                    Manifest(manifest_path),
+                )
+                drought.dates["fapar"] = [
+                    datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+                ]
+                drought.downloaded_data["fapar"] = [
+                    join(tempdir, "fpanv_m_gdo_20250101_20250601_t.zip")
+                ]
+                drought.country_data["fapar"] = {"CUB": [country_zip]}
+                return drought
+
+            drought = get_drought()
+            dataset = drought.generate_dataset("CUB", "fapar")
+            assert [r["name"] for r in dataset.get_resources()] == [
+                "cub_fpanv_m_gdo_20250101_20250601_t.zip"
+            ]
+            drought.record_published("CUB", "fapar")
+            drought.record_processed()
+
+            drought = get_drought()
+            assert drought.generate_dataset("CUB", "fapar") is None
+            assert Manifest(manifest_path).get_files("fapar") == {
+                "fpanv_m_gdo_20250101_20250601_t.zip"
+            }
+
+    def test_ghsl_manifest(self, configuration):
+        with (
+            temp_dir("TestGHSLManifest") as tempdir,
+            Download(user_agent="test") as downloader,
+        ):
+            retriever = Retrieve(downloader, tempdir, tempdir, tempdir)
+            boundaries = GeoDataFrame({"ISO_3": []}, geometry=[], crs="ESRI:54009")
+            manifest_path = join(tempdir, "state", "ghsl_manifest.json")
+            country_data = {}
+            for data_type in ("built", "population"):
+                tif_path = join(tempdir, f"cub_{data_type}.tif")
+                write_raster(tif_path, arange(16, dtype="uint8").reshape(1, 4, 4))
+                country_data[data_type] = tif_path
+
+            def get_ghsl(built_year):
+                ghsl = GHSL(
+                    configuration["ghsl"],
+                    retriever,
+                    boundaries,
+                    manifest=Manifest(manifest_path),
+                )
+                ghsl.data_year = {"built": built_year, "population": 2025}
+                ghsl.country_data["CUB"] = country_data
+                return ghsl
+
+            ghsl = get_ghsl(2025)
+            dataset = ghsl.generate_dataset("CUB")
+            assert len(dataset.get_resources()) == 2
+            ghsl.record_published("CUB")
+
+            ghsl = get_ghsl(2025)
+            assert ghsl.generate_dataset("CUB") is None
+
+            # An unchanged raster is published again for a new epoch so that
+            # its description is updated
+            ghsl = get_ghsl(2030)
+            dataset = ghsl.generate_dataset("CUB")
+            resources = dataset.get_resources()
+            assert len(resources) == 1
+            assert "Epoch: 2030" in resources[0]["description"]
+            ghsl.record_published("CUB")
+            ghsl = get_ghsl(2030)
+            assert ghsl.generate_dataset("CUB") is None
+
+    def test_check_output_profile(self, configuration):
+        for section in ("drought", "ghsl"):
+            check_output_profile(configuration[section]["output_profile"])
+        output_profile = dict(configuration["ghsl"]["output_profile"], blocksize=333)
+        with pytest.raises(ValueError, match="multiple of 16"):
+            check_output_profile(output_profile)
+        with (
+            temp_dir("TestCheckOutputProfile") as tempdir,
+            Download(user_agent="test") as downloader,
+        ):
+            retriever = Retrieve(downloader, tempdir, tempdir, tempdir)
+            boundaries = GeoDataFrame({"ISO_3": []}, geometry=[], crs="EPSG:4326")
+            drought_configuration = dict(
+                configuration["drought"], output_profile=output_profile
+            )
+            with pytest.raises(ValueError, match="multiple of 16"):
+                Drought(drought_configuration, retriever, boundaries)
+
+    def test_content_hash(self):
+        with temp_dir("TestContentHash") as tempdir:
+            data = arange(300 * 200, dtype="int16").reshape(1, 300, 200)
+            lzw_path = join(tempdir, "lzw.tif")
+            write_raster(lzw_path, data, compress="LZW")
+            deflate_path = join(tempdir, "deflate.tif")
+            write_raster(
+                deflate_path,
+                data,
+                compress="DEFLATE",
+                tiled=True,
+                blockxsize=128,
+                blockysize=128,
+            )
+            assert get_content_hash(lzw_path) == get_content_hash(deflate_path)
+            data[0, 150, 100] = -1
+            changed_path = join(tempdir, "changed.tif")
+            write_raster(changed_path, data, compress="LZW")
+            assert get_content_hash(lzw_path) != get_content_hash(changed_path)
+
+    def test_mask_index(self):
+        geometry = [mapping(Polygon([(-79.9, 19.9), (-79.5, 19.7), (-79.8, 17.3)]))]
+        outside = [mapping(Polygon([(0, 0), (1, 0), (1, 1)]))]
+        with temp_dir("TestMaskIndex") as tempdir:
+            tif_path = join(tempdir, "fapar.tif")
+            data = arange(300 * 200, dtype="int16").reshape(1, 300, 200)
+            write_raster(tif_path, data, nodata=-1)
+            with rasterio.open(tif_path) as dataset:
+                expected, expected_transform = mask(
+                    dataset, geometry, all_touched=True, crop=True
+                )
+                for _ in range(2):
+                    mask_index = MaskIndex(tempdir, "boundaries")
+                    window, shape_mask = mask_index.get(dataset, "CUB", geometry)
+                    raster, meta = clip_raster(dataset, window, shape_mask)
+                    assert (raster == expected).all()
+                    assert meta["transform"] == expected_transform
+                    assert mask_index.get(dataset, "FJI", outside) is None
+            assert len(glob(join(tempdir, "masks_*", "*.npz"))) == 2
+
+    def test_simplify_geometry(self):
+        # A coastline with detail far finer than the 0.01 degree pixels
+        angles = linspace(0, 6.28, 20000)
+        radii = 0.5 + 0.001 * sin(angles * 997)
+        coastline = Polygon(
+            zip(-79 + radii * cos(angles), 19 + radii * sin(angles))
+        ).buffer(0)
+        geometry = [mapping(coastline)]
+        assert simplify_geometry(geometry, 0.01, 0) is geometry
+        simplified = simplify_geometry(geometry, 0.01, 0.5)
+        assert len(shape(simplified[0]).exterior.coords) < 100
+        assert shape(simplified[0]).contains(coastline)
+        transform = from_origin(-80, 20, 0.01, 0.01)
+        inside = ~geometry_mask(geometry, (200, 200), transform, all_touched=True)
+        simplified_inside = ~geometry_mask(
+            simplified, (200, 200), transform, all_touched=True
+        )
+        assert (simplified_inside[inside]).all()
+        assert simplified_inside.sum() - inside.sum() < 0.01 * inside.sum()
+
+    def test_listing_cache(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), ListingHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/"
+        try:
+            with (
+                temp_dir("TestListingCache") as tempdir,
+                Download(user_agent="test", retry_attempts=0) as downloader,
+            ):
+                retriever = Retrieve(downloader, tempdir, tempdir, tempdir)
+                listing_cache = ValidatorCache(join(tempdir, "listings.json"))
+                lines = get_lines(retriever, url, listing_cache=listing_cache)
+                assert lines == ["../", "ver1-0-0/"]
+                listing_cache = ValidatorCache(join(tempdir, "listings.json"))
+                lines = get_lines(retriever, url, listing_cache=listing_cache)
+                assert lines == ["../", "ver1-0-0/"]
+                ListingHandler.listing = ("v2", '<a href="ver1-0-1/">ver1-0-1/</a>')
+                lines = get_lines(retriever, url, listing_cache=listing_cache)
+                assert lines == ["ver1-0-1/"]
+                assert ListingHandler.statuses == [200, 304, 200]
+                server.shutdown()
+                server.server_close()
+                # The cached listing is used if the server cannot be reached
+                lines = get_lines(retriever, url, listing_cache=listing_cache)
+                assert lines == ["ver1-0-1/"]
+                listing_cache = ValidatorCache(join(tempdir, "empty.json"))
+                with pytest.raises(DownloadError, match="failed"):
+                    get_lines(retriever, url, listing_cache=listing_cache, timeout=1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_get_file_sizes(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), SizeHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+        urls = [f"{url}/built.zip", f"{url}/population.zip"]
+        try:
+            with (
+                temp_dir("TestGetFileSizes") as tempdir,
+                Download(user_agent="test") as downloader,
+            ):
+                retriever = Retrieve(downloader, tempdir, tempdir, tempdir)
+                size_cache = ValidatorCache(join(tempdir, "sizes.json"))
+                sizes = get_file_sizes(retriever, urls, 2, size_cache=size_cache)
+                assert sizes == {urls[0]: 3 * 1024**3, urls[1]: 1024**3}
+                size_cache = ValidatorCache(join(tempdir, "sizes.json"))
+                sizes = get_file_sizes(retriever, urls, 2, size_cache=size_cache)
+                assert sizes == {urls[0]: 3 * 1024**3, urls[1]: 1024**3}
+                assert sorted(SizeHandler.statuses) == [200, 200, 304, 304]
+                with pytest.raises(DownloadError, match="no Content-Length"):
+                    get_file_sizes(retriever, [f"{url}/chunked.zip"], 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_get_lines(self, input_dir):
+        with (
+            temp_dir("TestGetLines") as tempdir,
+            Download(user_agent="test") as downloader,
+        ):
+            retriever = Retrieve(
+                downloader, tempdir, input_dir, tempdir, save=False, use_saved=True
+            )
+            for file_path in sorted(glob(join(input_dir, "*.txt"))):
+                with open(file_path) as f:
+                    soup = BeautifulSoup(f.read(), "html.parser")
+                hrefs = [a.get("href") for a in soup.find_all("a") if a.get("href")]
+                lines = get_lines(retriever, "unused", filename=basename(file_path))
+                assert lines == hrefs
+
+    def test_run_journal(self):
+        with temp_dir("TestRunJournal") as tempdir:
+            journal_path = join(tempdir, "journal.json")
+            tif_path = join(tempdir, "GHS_POP_E2020_R2023A_54009_100_V1_0_CUB.tif")
+            with open(tif_path, "w") as f:
+                f.write("tif")
+            journal = RunJournal(journal_path)
+            journal.mark_done("process", "ghsl/CUB", {"population": tif_path})
+            journal.mark_done("process", "ghsl/JAM", {})
+            journal.mark_done("publish", "cub-ghsl")
+
+            assert RunJournal(journal_path).get("publish", "cub-ghsl") is None
+            journal = RunJournal(journal_path, resume=True)
+            assert journal.get("process", "ghsl/CUB") == {"population": tif_path}
+            assert journal.get("process", "ghsl/JAM") == {}
+            assert journal.get("process", "ghsl/HTI") is None
+            assert journal.get("publish", "cub-ghsl") is True
+            remove(tif_path)
+            assert journal.get("process", "ghsl/CUB") is None
+
+            # Drought countries are processed again if the global files change
+            dekads = [join(tempdir, f"fpanv_m_gdo_2025010{i}_t.zip") for i in (1, 2)]
+            for dekad in dekads:
+                with open(dekad, "w") as f:
+                    f.write("zip")
+            journal.mark_done(
+                "process",
+                "fapar/CUB",
+                {"global_files": dekads[:1], "country_files": []},
+            )
+            file_paths = {dekads[0]: ["fpanv_m_gdo_20250101_t.tif"]}
+            assert (
+                get_processed_drought_files(journal, "fapar", "CUB", file_paths) == []
+            )
+            file_paths[dekads[1]] = ["fpanv_m_gdo_20250102_t.tif"]
+            assert (
+                get_processed_drought_files(journal, "fapar", "CUB", file_paths) is None
+            )
+            assert get_processed_drought_files(journal, "fapar", "JAM", {}) is None